@@ -0,0 +1,124 @@
+import html
+import re
+from collections import Counter
+from functools import lru_cache
+
+import nltk
+from bs4 import BeautifulSoup
+from nltk.stem import PorterStemmer
+
+from frontier import normalize_url
+
+PUNCTUATION = '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'
+WORD_REGEX = re.compile(r"[^\W\d_]+")  # regex for words
+MAX_TEXT_LENGTH = 10000  # characters of the text of a page stored for its snippets
+
+# Built once at import and shared by the crawler workers and the Query Handler of a process
+stop_words = frozenset(nltk.corpus.stopwords.words("english"))
+stemmer = PorterStemmer()
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+    '''
+    This function returns the lowercase stem of a word, remembering the most recent words of the process.
+    '''
+    return stemmer.stem(word).lower()
+
+
+def analyze_words(tokens):
+    '''
+    This function returns the index terms of a list of tokens: the first word of every token that is not
+    punctuation, without the stop words, stemmed and converted to lowercase. Pages and queries are analyzed
+    with this same function, so the terms of a query are the terms of the index.
+    '''
+    words = [WORD_REGEX.findall(token) for token in tokens if token not in PUNCTUATION]
+    words = [word[0] for word in words if word]
+    return [stem(word) for word in words if not word.startswith("wg") and word not in stop_words]
+
+
+def analyze_page(url, html):
+    '''
+    This function extracts the title, the links, the bag of words, the positions of every word and
+    the beginning of the text of a downloaded page. It returns None if the page has no title or could not be analyzed.
+    '''
+    try:
+        raw = BeautifulSoup(html, 'html.parser')
+        title = raw.title.string
+    except Exception:
+        return None
+    try:
+        # Find all new urls to other pages, relative links are resolved against the page url
+        links = []
+        for link in raw.findAll('a'):
+            link_url = normalize_url(url, link.get('href'))
+            if link_url is not None:
+                links.append(link_url)
+
+        # Remove the special characters and the stop words, stem and convert to lowercase all words
+        text = raw.get_text()
+        lowercase_words = analyze_words(nltk.word_tokenize(text))
+        # Positions of every word in the analyzed words, used by the positional index
+        positions = {}
+        for position, word in enumerate(lowercase_words):
+            positions.setdefault(word, []).append(position)
+        return {"url": url, "title": title, "links": links, "bag": Counter(lowercase_words),
+                "positions": positions, "text": " ".join(text.split())[:MAX_TEXT_LENGTH]}
+    except Exception:  # something went wrong during this phase, so we will not have any results
+        return None
+
+
+def analyze_batch(pages):
+    '''
+    This function analyzes a batch of (url, html) pages in a worker process.
+    '''
+    return [analyze_page(url, html) for url, html in pages]
+
+
+def make_snippet(text, terms, length=30):
+    '''
+    This function returns the passage of length words of a text that contains the most distinct query
+    terms, as HTML with the words of the terms in bold. The words of the text are analyzed like the
+    words of the pages, so "running" is highlighted for the term "run".
+    '''
+    words = list(WORD_REGEX.finditer(text))
+    if not words:
+        return ""
+    terms = set(terms)
+    hits = [i for i, word in enumerate(words)
+            if word.group() not in stop_words and stem(word.group()) in terms]
+    # The window of length words with the most distinct terms, starting at a hit
+    hit_terms = [stem(words[hit].group()) for hit in hits]
+    start, best = 0, 0
+    window = Counter()
+    j = 0
+    for i, first in enumerate(hits):
+        while j < len(hits) and hits[j] < first + length:
+            window[hit_terms[j]] += 1
+            j += 1
+        if len(window) > best:
+            start, best = first, len(window)
+        window[hit_terms[i]] -= 1
+        if window[hit_terms[i]] == 0:
+            del window[hit_terms[i]]
+    # A few words of context before the first hit
+    start = max(0, min(start - 3, len(words) - length))
+    end = min(len(words), start + length)
+    hits = set(hits)
+
+    pieces = []
+    position = words[start].start()
+    for i in range(start, end):
+        word = words[i]
+        pieces.append(html.escape(text[position:word.start()]))
+        if i in hits:
+            pieces.append("<b>" + html.escape(word.group()) + "</b>")
+        else:
+            pieces.append(html.escape(word.group()))
+        position = word.end()
+    snippet = "".join(pieces)
+    if start > 0:
+        snippet = "..." + snippet
+    if end < len(words):
+        snippet += "..."
+    return snippet
@@ -1,16 +1,310 @@
-from flask import Flask, render_template, url_for, request, redirect
+from flask import Flask, render_template, url_for, request, redirect, jsonify, g, Response
+import base64
+import cProfile
+import json
+import os
 import sys
-from mongodb import MongoDB
+import threading
+import time
+from cache import LRUCache
+from metrics import registry as metrics
 from query_handler import QueryHandler
 
 app = Flask(__name__)
-mongo = MongoDB()
+# Results of recent queries, emptied when the index is rebuilt
+query_cache = LRUCache(max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=3600)
+# Ranked document numbers of recent API queries, so that the next pages are not scored again
+ranking_cache = LRUCache(max_entries=1000, max_bytes=32 * 1024 * 1024, ttl=600)
+RANKING_DEPTH = 100  # documents ranked at least for a paginated query
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
+# Requests are profiled with cProfile if PROFILE_DIR is set, one at a time, and their stats saved there
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+profile_locker = threading.Lock()
+# Shared by all the threads of the process, created by the first request
+query_handler = None
+query_handler_locker = threading.Lock()
+
+
+def get_query_handler():
+    '''
+    This function returns the Query Handler of the process, creating it on first use. It is configured
+    by the QUERY_HANDLER_THREADS, BINARY_INDEX_PATH, SEGMENT_INDEX_PATH, SNAPSHOT_PATH,
+    POSITIONAL_INDEX_PATH, DEFAULT_OPERATOR and PRUNING (MaxScore dynamic pruning, off unless "true")
+    environment variables, so that every worker process of a WSGI server creates its own Query Handler.
+    '''
+    global query_handler
+    if query_handler is None:
+        with query_handler_locker:
+            if query_handler is None:
+                query_handler = QueryHandler(int(os.getenv("QUERY_HANDLER_THREADS", 5)),
+                                             index_path=os.getenv("BINARY_INDEX_PATH"),
+                                             segment_path=os.getenv("SEGMENT_INDEX_PATH"),
+                                             snapshot_path=os.getenv("SNAPSHOT_PATH"),
+                                             positional_path=os.getenv("POSITIONAL_INDEX_PATH"),
+                                             default_operator=os.getenv("DEFAULT_OPERATOR", "OR"),
+                                             pruning=parse_flag(os.getenv("PRUNING", False)))
+    return query_handler
+
+
+def warm_up():
+    '''
+    This function creates the Query Handler of the process and loads its index before the first request.
+    '''
+    get_query_handler().warm_up()
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.profile = None
+    # Requests that arrive while another one is profiled are not profiled
+    if PROFILE_DIR and profile_locker.acquire(blocking=False):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+@app.after_request
+def finish_request(response):
+    '''
+    This function records the latency of every request by route and saves its profile if it was profiled.
+    '''
+    endpoint = request.endpoint or "unknown"
+    metrics.observe("http_request_seconds", time.perf_counter() - g.request_start, endpoint=endpoint)
+    metrics.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def stop_profile(exception):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+        profile_locker.release()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile.dump_stats(os.path.join(PROFILE_DIR, "{endpoint}-{time}.prof".format(
+            endpoint=request.endpoint or "unknown", time=time.time_ns())))
+
+
+def search(query_keywords, top_k, snippets=False):
+    '''
+    This function returns the results of a query from the query cache, or executes the query
+    using the Search Engine's Query Handler and caches its results. Queries with the same weighted
+    index terms in any order share the same results.
+    '''
+    query_handler = get_query_handler()
+    generation = query_handler.get_index_generation()
+    query_cache.check_version(generation)
+    key = (query_key(query_handler, query_keywords), top_k, snippets)
+    query_results = query_cache.get(key)
+    if query_results is None:
+        query_results = query_handler.main(query_keywords, top_k, snippets)
+        # Results of a query that ran while the index changed may be of the previous index
+        if query_handler.get_index_generation() == generation:
+            query_cache.put(key, query_results)
+    # The results are changed by the caller, so every request gets its own copy
+    return [dict(result) for result in query_results]
+
+
+def query_key(query_handler, query):
+    '''
+    This function returns the weighted index terms of a query in a canonical order, together with its
+    phrases and boolean clauses, used as cache key.
+    '''
+    query_filter = query_handler.query_filter(query)
+    if query_filter is not None:
+        phrases, clauses = query_filter
+        query_filter = (tuple((tuple(terms), window) for terms, window in phrases),
+                        tuple(tuple(sorted(clause)) for clause in clauses) if clauses is not None else None)
+    return tuple(sorted(query_handler.query_vector(query).items())), query_filter
+
+
+def search_batch(queries):
+    '''
+    This function returns the results of many (query keywords, top k) pairs. The queries that are not
+    in the query cache are executed together, sharing the lookups of their terms.
+    '''
+    query_handler = get_query_handler()
+    generation = query_handler.get_index_generation()
+    query_cache.check_version(generation)
+    keys = [(query_key(query_handler, query), top_k) for query, top_k in queries]
+    batch_results = [query_cache.get(key) for key in keys]
+    missing = [i for i, query_results in enumerate(batch_results) if query_results is None]
+    if missing:
+        missing_results = query_handler.search_batch([queries[i] for i in missing])
+        cacheable = query_handler.get_index_generation() == generation
+        for i, query_results in zip(missing, missing_results):
+            if cacheable:
+                query_cache.put(keys[i], query_results)
+            batch_results[i] = query_results
+    return [[dict(result) for result in query_results] for query_results in batch_results]
+
+
+def search_page(query_keywords, offset, page_size, generation, snippets=False):
+    '''
+    This function returns a page of the results of a query and whether there may be more results.
+    The ranked document numbers of the query are cached, so the next pages only fetch their documents,
+    and the query is ranked again, twice as deep, only when a page goes past the cached ranking.
+    If snippets is True the results also have snippets of their text.
+    '''
+    query_handler = get_query_handler()
+    ranking_cache.check_version(generation)
+    key = query_key(query_handler, query_keywords)
+    end = offset + page_size
+    ranking = ranking_cache.get(key)
+    # A ranking shorter than its depth has all the matching documents
+    if ranking is None or (len(ranking[1]) == ranking[2] < end):
+        depth = max(RANKING_DEPTH, 2 * end)
+        engine, doc_nums = query_handler.rank_documents(query_keywords, depth)
+        ranking = (engine, doc_nums, depth)
+        if query_handler.get_index_generation() == generation:
+            ranking_cache.put(key, ranking, size=64 + 8 * len(doc_nums))
+    engine, doc_nums, depth = ranking
+    terms = query_handler.query_vector(query_keywords) if snippets else None
+    page = query_handler.find_documents(doc_nums[offset:end], engine, terms)
+    return page, end < len(doc_nums) or len(doc_nums) == depth
+
+
+def encode_cursor(query_keywords, offset, generation):
+    state = json.dumps({"q": query_keywords, "o": offset, "g": generation}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(state.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    '''
+    This function returns the query, offset and index generation of a cursor, or raises ValueError.
+    '''
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8"))
+        return parse_query(state["q"]), int(state["o"]), state["g"]
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError("invalid cursor") from error
+
+
+def parse_query(query):
+    '''
+    This function returns the query keywords of an API query, given as a string of keywords, a list of
+    keywords or a weighted query vector (term -> weight). It raises ValueError for anything else.
+    '''
+    if isinstance(query, str):
+        query = query.split()
+    if isinstance(query, list) and all(isinstance(keyword, str) for keyword in query):
+        return query
+    if isinstance(query, dict) and all(isinstance(weight, (int, float)) for weight in query.values()):
+        return query
+    raise ValueError("q must be a string, a list of keywords or a dictionary of term weights")
+
+
+def parse_page_size(value):
+    try:
+        page_size = int(value)
+    except TypeError:
+        raise ValueError("k must be an integer")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError("k must be between 1 and {max}".format(max=MAX_PAGE_SIZE))
+    return page_size
+
+
+def parse_flag(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def result_to_json(result, rank):
+    result_json = {"rank": rank, "id": str(result["_id"]), "title": result["title"], "url": result["url"]}
+    if "snippet" in result:
+        result_json["snippet"] = result["snippet"]
+    return result_json
+
+
+def api_error(message, status=400):
+    return jsonify({"error": message}), status
+
+
+@app.route('/api/search', methods=['GET', 'POST'])
+def api_search():
+    '''
+    This route returns a page of the results of a query as JSON. The query is given by the q and k
+    (page size) parameters, as query string or JSON body, and the next pages by the returned next_cursor.
+    A cursor is valid until the index is rebuilt. If the snippets parameter is true every result also has
+    a snippet of its text as HTML, with the query terms in bold.
+    '''
+    if not get_query_handler().is_initialized():
+        return api_error("the index has not been built yet", 503)
+    params = request.get_json(silent=True) or request.values
+    generation = get_query_handler().get_index_generation()
+    try:
+        page_size = parse_page_size(params.get("k", 10))
+        snippets = parse_flag(params.get("snippets", False))
+        cursor = params.get("cursor")
+        if cursor:
+            query_keywords, offset, cursor_generation = decode_cursor(cursor)
+            if cursor_generation != generation:
+                return api_error("cursor expired, the index has been rebuilt", 410)
+        else:
+            query_keywords, offset = parse_query(params.get("q", "")), 0
+    except ValueError as error:
+        return api_error(str(error))
+
+    page, more = search_page(query_keywords, offset, page_size, generation, snippets)
+    next_offset = offset + page_size
+    return jsonify({"results": [result_to_json(result, offset + i) for i, result in enumerate(page)],
+                    "next_cursor": encode_cursor(query_keywords, next_offset, generation) if more else None})
+
+
+@app.route('/api/search/batch', methods=['POST'])
+def api_search_batch():
+    '''
+    This route executes many queries given as the JSON body {"queries": [...], "k": 10}, where every
+    query is a query like the q parameter of /api/search or an object {"q": ..., "k": ...}, and returns
+    the top k results of every query in the same order.
+    '''
+    if not get_query_handler().is_initialized():
+        return api_error("the index has not been built yet", 503)
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict) or not isinstance(params.get("queries"), list):
+        return api_error("the body must be a JSON object with a list of queries")
+    if len(params["queries"]) > MAX_BATCH_SIZE:
+        return api_error("at most {max} queries per batch".format(max=MAX_BATCH_SIZE))
+    try:
+        default_k = parse_page_size(params.get("k", 10))
+        queries = []
+        for query in params["queries"]:
+            if isinstance(query, dict) and "q" in query:
+                queries.append((parse_query(query["q"]), parse_page_size(query.get("k", default_k))))
+            else:
+                queries.append((parse_query(query), default_k))
+    except ValueError as error:
+        return api_error(str(error))
+
+    batch_results = search_batch(queries)
+    return jsonify({"results": [[result_to_json(result, i) for i, result in enumerate(query_results)]
+                                for query_results in batch_results]})
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    '''
+    This route returns the counters and latency histograms of the process in the Prometheus text format.
+    '''
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/stats/cache')
+def cache_stats():
+    '''
+    This route returns the hits, misses and size of the query cache, of the posting lists cached by the
+    Query Handler and of the term and document caches of the database for monitoring.
+    '''
+    stats = {"queries": query_cache.stats()}
+    stats["postings"] = get_query_handler().postings_cache.stats()
+    stats.update(get_query_handler().db.cache_stats())
+    return jsonify(stats)
 
 
 @app.route('/', methods=['POST', 'GET'])
 def index():
     
-    index_initialized = mongo.is_initialized()
+    index_initialized = get_query_handler().is_initialized()
     if index_initialized:
 
         if request.method == 'POST':
@@ -25,23 +319,16 @@ def index():
 
             # Execute the query using the Search Engine's Query Handler
 
-            query_results = query_handler.main(query_keywords, top_k)
+            query_results = search(query_keywords, top_k)
             rel = [query_results[i]["_id"]
                    for i in range(len(query_results)) if i in ids]
             nonrel = [query_results[i]["_id"]
                       for i in range(len(query_results)) if i not in ids]
             #if the user has selected relevant document IDs compute new query with Rocchio formula
             if ids != []:
-                q = query_handler.rocchio_relevance_feedback(rel, nonrel)
-                i=0
-                new_query=[]
-                for k in q.keys():
-                    new_query.append(k)
-                    i=i+1 
-                
-            #if the user has selected relevant document IDs get new query results
-            if ids != []:
-                query_results = query_handler.main(new_query, top_k)
+                new_query = get_query_handler().rocchio_relevance_feedback(rel, nonrel, query_keywords)
+                # Execute the new query as a weighted query vector
+                query_results = search(new_query, top_k)
             for i in range(len(query_results)):
                 query_results[i]["num"] = i
 
@@ -55,8 +342,17 @@ def index():
 
 if __name__ == "__main__":
     '''
-    Main method to run flask server and initialize a QueryHandler object
+    Main method to run flask server and initialize a QueryHandler object.
+    Requests are served by concurrent threads; in production run the app with a WSGI server
+    instead, e.g. gunicorn --workers 4 --threads 8 wsgi:app
     '''
-    query_handler = QueryHandler(int(sys.argv[1]))
+    # An optional second argument is the path of a binary index exported by the indexer
+    index_path = str(sys.argv[2]) if len(sys.argv) > 2 else None
+    query_handler = QueryHandler(int(sys.argv[1]), index_path=index_path,
+                                 segment_path=os.getenv("SEGMENT_INDEX_PATH"),
+                                 snapshot_path=os.getenv("SNAPSHOT_PATH"),
+                                 positional_path=os.getenv("POSITIONAL_INDEX_PATH"),
+                                 default_operator=os.getenv("DEFAULT_OPERATOR", "OR"),
+                                 pruning=parse_flag(os.getenv("PRUNING", False)))
     print("Starting Flask Server...")
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
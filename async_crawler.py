@@ -0,0 +1,116 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from crawler import Crawler
+from metrics import registry as metrics
+
+
+class AsyncCrawler(Crawler):
+    '''
+    This class crawls pages like the Crawler, but downloads them with asyncio and an aiohttp client
+    session instead of one thread per url. Connections are kept alive and pooled, at most max_in_flight
+    downloads run at the same time, at most per_host of them to the same host, and consecutive downloads
+    from the same host are started at least crawl_delay seconds apart. The downloaded pages are
+    analyzed by the worker processes of the Crawler, so parsing does not block the downloads.
+    '''
+
+    def __init__(self, url: str, keep: bool, max_size: int, num_threads: int, timeout: float = 10,
+                 max_in_flight: int = 200, per_host: int = 8, crawl_delay: float = 0.0, **kwargs):
+        # The other options of the Crawler, e.g. state_dir, index_mode or db, are passed through
+        super().__init__(url, keep, max_size, num_threads, timeout, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.crawl_delay = crawl_delay
+
+    def crawl_pages(self):
+        '''
+        This method crawls the pages running the asyncio event loop until it finishes.
+        '''
+        asyncio.run(self.crawl_pages_async())
+
+    async def crawl_pages_async(self):
+        '''
+        This method schedules a download for every url until there are no more urls to crawl or
+        we have reached the maximum number of crawled pages.
+        '''
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.host_slots = {}  # host -> semaphore limiting the concurrent downloads from the host
+        self.next_fetch = {}  # host -> earliest loop time the next download from the host can start
+
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = {}  # task -> url it downloads
+            while self.crawled_pages < self.max_size:
+                # Urls waiting for their host are scheduled too, so there can be more tasks than downloads
+                if len(self.urls) > 0 and len(tasks) < 4 * self.max_in_flight:
+                    url = self.urls.pop()
+                    tasks[asyncio.create_task(self.parse_async(session, url))] = url
+                    continue
+                if not tasks:
+                    # The links of the downloaded pages are the only source of new urls
+                    self.flush_pages()
+                    # If there are no urls to crawl and no pages to analyze exit
+                    if self.pending_batches == 0 and len(self.urls) == 0:
+                        break
+                    await asyncio.sleep(0.05)
+                    continue
+                # Wake up periodically to schedule the urls found by the analysis workers
+                done, _ = await asyncio.wait(tasks, timeout=0.1, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del tasks[task]
+
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # The urls of the cancelled downloads are crawled on resume
+            self.keep_unsaved([url for task, url in tasks.items() if task.cancelled()])
+
+    async def parse_async(self, session, url):
+        '''
+        This method downloads a page and hands it to the analysis workers.
+        '''
+        html = await self.fetch(session, url)
+        if html is None:
+            return
+        if self.crawled_pages < self.max_size:
+            self.submit_page(url, html)
+        else:
+            self.keep_unsaved([url])
+
+    async def fetch(self, session, url):
+        '''
+        This method downloads a page respecting the concurrency limits and the crawl delay of its host.
+        It returns the html of the page, or None if the page could not be downloaded.
+        '''
+        try:
+            host = urlsplit(url).netloc
+        except ValueError:
+            return None
+        host_slot = self.host_slots.setdefault(host, asyncio.Semaphore(self.per_host))
+        async with host_slot:
+            # Reserve the next start time of the host before waiting, so waiting downloads are spaced out
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            start = max(now, self.next_fetch.get(host, now))
+            self.next_fetch[host] = start + self.crawl_delay
+            if start > now:
+                await asyncio.sleep(start - now)
+            async with self.in_flight:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        if response.status != 200:
+                            metrics.inc("crawler_fetches_total", result="error")
+                            return None
+                        html = await response.text(encoding="utf8")
+                        metrics.inc("crawler_fetches_total", result="ok")
+                        return html
+                except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError, ValueError):
+                    metrics.inc("crawler_fetches_total", result="error")
+                    return None
+                finally:
+                    metrics.observe("crawler_stage_seconds", time.perf_counter() - start, stage="fetch")
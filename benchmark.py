@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from bisect import bisect_left
+from itertools import accumulate
+
+import analyzer
+from mongodb import MongoDB
+
+
+def vocabulary(vocab_size):
+    '''
+    This function returns vocab_size distinct alphabetic words that are their own index terms, so that
+    they are kept unchanged by the analyzer of the pages and of the queries.
+    '''
+    words = []
+    number = 0
+    while len(words) < vocab_size:
+        i = number
+        number += 1
+        word = ""
+        while True:
+            i, letter = divmod(i, len(string.ascii_lowercase))
+            word += string.ascii_lowercase[letter]
+            if i == 0:
+                break
+        if analyzer.analyze_words(["qz" + word]) == ["qz" + word]:
+            words.append("qz" + word)
+    return words
+
+
+class ZipfSampler:
+    '''
+    This class samples word ranks with probability proportional to 1 / rank ** exponent,
+    the term distribution of natural language text.
+    '''
+
+    def __init__(self, size, exponent, rnd):
+        self.cumulative_weights = list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(size)))
+        self.rnd = rnd
+
+    def sample(self):
+        return bisect_left(self.cumulative_weights, self.rnd.random() * self.cumulative_weights[-1])
+
+
+def generate_corpus(num_docs, vocab_size, zipf_exponent, doc_length, seed):
+    '''
+    This function returns a synthetic crawled corpus of num_docs records whose words follow a Zipf
+    distribution over the vocabulary. Document lengths are uniform between 1 and 2 * doc_length words.
+    '''
+    rnd = random.Random(seed)
+    words = vocabulary(vocab_size)
+    sampler = ZipfSampler(vocab_size, zipf_exponent, rnd)
+    records = []
+    for doc_num in range(num_docs):
+        bag = {}
+        for _ in range(rnd.randint(1, 2 * doc_length)):
+            word = words[sampler.sample()]
+            bag[word] = bag.get(word, 0) + 1
+        records.append({"url": "http://benchmark.local/{num}".format(num=doc_num),
+                        "title": "Document {num}".format(num=doc_num), "bag": bag})
+    return records
+
+
+def generate_queries(num_queries, vocab_size, zipf_exponent, max_terms, seed):
+    '''
+    This function returns num_queries lists of 1 to max_terms keywords drawn from the Zipf distribution
+    of the corpus, so that frequent terms with long posting lists are queried more often.
+    '''
+    rnd = random.Random(seed + 1)
+    words = vocabulary(vocab_size)
+    sampler = ZipfSampler(vocab_size, zipf_exponent, rnd)
+    return [[words[sampler.sample()] for _ in range(rnd.randint(1, max_terms))] for _ in range(num_queries)]
+
+
+def render_page(record):
+    words = " ".join(word for word, count in record["bag"].items() for _ in range(count))
+    return ("<html><head><title>{title}</title></head><body><p>{words}</p>"
+            "<a href=\"/next\">next</a></body></html>").format(title=record["title"], words=words)
+
+
+def latency_summary(latencies):
+    '''
+    This function returns the mean, maximum and 50th, 95th and 99th percentile of latencies in milliseconds.
+    '''
+    latencies = sorted(latency * 1000 for latency in latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+
+    return {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99),
+            "mean": sum(latencies) / len(latencies), "max": latencies[-1]}
+
+
+def peak_memory(function):
+    '''
+    This function runs function with memory tracing and returns the peak memory it allocated in bytes.
+    '''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    This context manager discards the progress messages printed by the search engine.
+    '''
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    '''
+    This class benchmarks the hot paths of the search engine on a synthetic corpus: the analysis of
+    crawled pages, the construction of the inverted index and the execution of queries and Rocchio
+    relevance feedback, against the database and against an exported binary index. Timings are measured
+    without memory tracing, and the peak memory of every stage is measured by running it again traced.
+    '''
+
+    def __init__(self, num_docs=2000, vocab_size=5000, zipf_exponent=1.0, doc_length=100, num_queries=500,
+                 max_query_terms=4, k=10, index_mode="bulk", seed=42, mongo=False):
+        self.num_docs = num_docs
+        self.vocab_size = vocab_size
+        self.zipf_exponent = zipf_exponent
+        self.doc_length = doc_length
+        self.num_queries = num_queries
+        self.max_query_terms = max_query_terms
+        self.k = k
+        self.index_mode = index_mode
+        self.seed = seed
+        self.mongo = mongo  # use the MongoDB server of the environment instead of mongomock
+        self.memory_queries = min(num_queries, 50)  # queries run again to measure the peak memory
+
+    def config(self):
+        return {"num_docs": self.num_docs, "vocab_size": self.vocab_size, "zipf_exponent": self.zipf_exponent,
+                "doc_length": self.doc_length, "num_queries": self.num_queries,
+                "max_query_terms": self.max_query_terms, "k": self.k, "index_mode": self.index_mode,
+                "seed": self.seed, "database": "mongodb" if self.mongo else "mongomock"}
+
+    def connect(self):
+        '''
+        This method returns the database of the benchmark, which is never the database of the search engine.
+        '''
+        if self.mongo:
+            return MongoDB(database="search_engine_benchmark")
+        import mongomock  # installed with requirements-dev.txt
+        return MongoDB(client=mongomock.MongoClient(), database="search_engine_benchmark")
+
+    def run(self):
+        '''
+        This method runs all the stages and returns the report.
+        '''
+        from indexer import Indexer
+        from query_handler import QueryHandler
+
+        report = {"config": self.config(), "commit": git_commit(), "python": platform.python_version(),
+                  "stages": {}}
+        records = generate_corpus(self.num_docs, self.vocab_size, self.zipf_exponent, self.doc_length, self.seed)
+        queries = generate_queries(self.num_queries, self.vocab_size, self.zipf_exponent,
+                                   self.max_query_terms, self.seed)
+        report["stages"]["analyze"] = self.benchmark_analyze(records)
+
+        db = self.connect()
+        db.reset_crawler()
+        db.crawler_db.insert_many([dict(record) for record in records])
+        indexer = Indexer(db=db)
+        report["stages"]["index"] = self.benchmark_index(indexer)
+
+        query_handler = QueryHandler(db=db)
+        report["stages"]["query"] = self.benchmark_queries(query_handler, queries)
+        report["stages"]["rocchio"] = self.benchmark_rocchio(query_handler, queries)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index")
+            with quiet():
+                indexer.export_binary_index(path)
+            binary_query_handler = QueryHandler(index_path=path, db=db)
+            report["stages"]["query_binary"] = self.benchmark_queries(binary_query_handler, queries)
+
+        db.reset_crawler()
+        db.reset_indexer()
+        return report
+
+    def benchmark_analyze(self, records):
+        '''
+        This method measures the analysis of crawled pages, the CPU bound part of the crawler.
+        '''
+        pages = [(record["url"], render_page(record)) for record in records]
+        if analyzer.analyze_batch(pages[:1])[0] is None:
+            return {"skipped": "the analyzer could not analyze a page"}
+
+        latencies = []
+        t1 = time.perf_counter()
+        for page in pages:
+            start = time.perf_counter()
+            analyzer.analyze_batch([page])
+            latencies.append(time.perf_counter() - start)
+        total = time.perf_counter() - t1
+        return {"pages": len(pages), "seconds": total, "pages_per_second": len(pages) / total,
+                "latency_ms": latency_summary(latencies),
+                "peak_memory_bytes": peak_memory(lambda: analyzer.analyze_batch(pages[:self.memory_queries]))}
+
+    def benchmark_index(self, indexer):
+        '''
+        This method measures a full build of the inverted index from the crawled records.
+        '''
+        with quiet():
+            t1 = time.perf_counter()
+            self.build_index(indexer)
+            total = time.perf_counter() - t1
+            memory = peak_memory(lambda: self.build_index(indexer))
+        return {"documents": self.num_docs, "seconds": total, "documents_per_second": self.num_docs / total,
+                "terms": indexer.db.indexer_db.count_documents({}), "peak_memory_bytes": memory}
+
+    def build_index(self, indexer):
+        '''
+        This method builds the inverted index. An incremental build starts from an empty index, so that
+        every crawled record is indexed as a new document.
+        '''
+        if self.index_mode == "incremental":
+            indexer.db.reset_indexer()
+        indexer.create_index(self.index_mode)
+
+    def benchmark_queries(self, query_handler, queries):
+        '''
+        This method measures the latency of the queries, starting with empty caches.
+        '''
+        query_handler.db.invalidate_caches()
+        latencies = []
+        with quiet():
+            query_handler.main(queries[0], self.k)  # load the scoring engine
+            t1 = time.perf_counter()
+            for query in queries:
+                start = time.perf_counter()
+                query_handler.main(query, self.k)
+                latencies.append(time.perf_counter() - start)
+            total = time.perf_counter() - t1
+            query_handler.db.invalidate_caches()
+            memory = peak_memory(lambda: [query_handler.main(query, self.k)
+                                          for query in queries[:self.memory_queries]])
+        return {"queries": len(queries), "seconds": total, "queries_per_second": len(queries) / total,
+                "latency_ms": latency_summary(latencies), "peak_memory_bytes": memory}
+
+    def benchmark_rocchio(self, query_handler, queries):
+        '''
+        This method measures Rocchio relevance feedback, judging the first two results of every query as
+        relevant and the rest as non relevant, and the execution of the expanded queries.
+        '''
+        with quiet():
+            judged = []
+            for query in queries:
+                ids = [result["_id"] for result in query_handler.main(query, self.k)]
+                if len(ids) > 2:
+                    judged.append((query, ids[:2], ids[2:]))
+            if not judged:
+                return {"skipped": "no query has more than two results"}
+
+            feedback_latencies = []
+            query_latencies = []
+            t1 = time.perf_counter()
+            for query, relevant, nonrelevant in judged:
+                start = time.perf_counter()
+                new_query = query_handler.rocchio_relevance_feedback(relevant, nonrelevant, query)
+                feedback_latencies.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                query_handler.main(new_query, self.k)
+                query_latencies.append(time.perf_counter() - start)
+            total = time.perf_counter() - t1
+            memory = peak_memory(lambda: [query_handler.rocchio_relevance_feedback(relevant, nonrelevant, query)
+                                          for query, relevant, nonrelevant in judged[:self.memory_queries]])
+        return {"feedbacks": len(judged), "seconds": total, "feedbacks_per_second": len(judged) / total,
+                "feedback_latency_ms": latency_summary(feedback_latencies),
+                "expanded_query_latency_ms": latency_summary(query_latencies), "peak_memory_bytes": memory}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the crawl, index and query hot paths "
+                                                 "on a synthetic corpus and print a JSON report.")
+    parser.add_argument("--docs", type=int, default=2000, help="number of documents")
+    parser.add_argument("--vocab", type=int, default=5000, help="vocabulary size")
+    parser.add_argument("--zipf", type=float, default=1.0, help="exponent of the Zipf term distribution")
+    parser.add_argument("--doc-length", type=int, default=100, help="average words per document")
+    parser.add_argument("--queries", type=int, default=500, help="number of queries")
+    parser.add_argument("--query-terms", type=int, default=4, help="maximum terms per query")
+    parser.add_argument("--k", type=int, default=10, help="results per query")
+    parser.add_argument("--index-mode", default="bulk", choices=["bulk", "threaded", "sharded", "incremental"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo", action="store_true",
+                        help="use the MongoDB server configured in .env instead of mongomock")
+    parser.add_argument("--output", help="write the report to this file instead of the standard output")
+    args = parser.parse_args(argv)
+    if args.index_mode == "sharded" and not args.mongo:
+        # The shard processes open their own connections, which cannot see a mongomock database
+        parser.error("--index-mode sharded requires --mongo")
+
+    benchmark = Benchmark(args.docs, args.vocab, args.zipf, args.doc_length, args.queries, args.query_terms,
+                          args.k, args.index_mode, args.seed, args.mongo)
+    report = json.dumps(benchmark.run(), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    '''
+    Main method to run the benchmarks, e.g. python benchmark.py --docs 5000 --output report.json
+    '''
+    main(sys.argv[1:])
@@ -0,0 +1,249 @@
+import hashlib
+import mmap
+import struct
+
+import numpy as np
+from bson import ObjectId
+
+POSTINGS_MAGIC = b"SEIX"
+DOCUMENTS_MAGIC = b"SEDT"
+VERSION = 3
+
+# magic, version, number of documents, number of terms, offset of the term dictionary
+POSTINGS_HEADER = struct.Struct("<4sIIIQ")
+# magic, version, number of documents, fingerprint of the document IDs
+DOCUMENTS_HEADER = struct.Struct("<4sIIQ")
+# maximum inverse document length of a posting list
+BOUND = struct.Struct("<d")
+
+
+def documents_fingerprint(doc_ids):
+    '''
+    This function returns a 64 bit hash of a list of document IDs in document number order. Files
+    that number the same documents the same way, such as a binary index and the positional index
+    exported with it, have the same fingerprint.
+    '''
+    digest = hashlib.blake2b(digest_size=8)
+    for doc_id in doc_ids:
+        digest.update(str(doc_id).encode("utf8") + b"\0")
+    return struct.unpack("<Q", digest.digest())[0]
+
+
+def encode_varints(values):
+    '''
+    This function encodes a list of non negative integers as variable length integers,
+    7 bits per byte with the high bit set on every byte except the last one of a value.
+    '''
+    encoded = bytearray()
+    for value in values:
+        while value >= 0x80:
+            encoded.append((value & 0x7F) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varints(buffer, offset, count):
+    '''
+    This function decodes count variable length integers from buffer starting at offset and
+    returns them together with the offset right after the last decoded byte.
+    '''
+    values = []
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buffer[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, offset
+
+
+def decode_varints_array(buffer, offset, size):
+    '''
+    This function decodes all the variable length integers stored in size bytes of buffer
+    starting at offset into a NumPy array, without a Python loop over the bytes.
+    '''
+    data = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset)
+    if size == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = data < 0x80
+    # The first byte of every value is the one after the last byte of the previous value
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    value_of_byte = np.cumsum(last) - last
+    shifts = (np.arange(size) - starts[value_of_byte]) * 7
+    payload = (data & 0x7F).astype(np.int64) << shifts
+    return np.add.reduceat(payload, starts)
+
+
+def encode_deltas(values):
+    '''
+    This function encodes a sorted list of integers as the varints of their differences.
+    '''
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return encode_varints(deltas)
+
+
+def decode_deltas(buffer, offset, count):
+    '''
+    This function decodes a list of integers encoded with encode_deltas.
+    '''
+    deltas, offset = decode_varints(buffer, offset, count)
+    values = []
+    previous = 0
+    for delta in deltas:
+        previous += delta
+        values.append(previous)
+    return values, offset
+
+
+def write_binary_index(path, documents, terms):
+    '''
+    This function writes an inverted index in the compact binary format. documents is the list
+    of documents ({"_id", "title", "url", "length"}) sorted by ID, and the position of a document
+    in this list is its document number. terms yields (term, t_freq, postings) in term order, where
+    postings is a list of (document number, t_d_freq) pairs. Two files are written: path.idx with the
+    posting lists and the term dictionary and path.docs with the document table. The dictionary also
+    stores the maximum inverse document length of every posting list, used for upper bound scores.
+    '''
+    inverse_lengths = [1.0 / document["length"] if document.get("length", 0.0) > 0 else 1.0
+                       for document in documents]
+    dictionary = []
+    with open(path + ".idx", "wb") as postings_file:
+        postings_file.write(b"\0" * POSTINGS_HEADER.size)
+        offset = POSTINGS_HEADER.size
+        for term, t_freq, postings in terms:
+            postings = sorted(postings)
+            blob = encode_deltas([doc_num for doc_num, _ in postings]) + \
+                encode_varints([t_d_freq for _, t_d_freq in postings])
+            postings_file.write(blob)
+            max_inverse_length = max((inverse_lengths[doc_num] for doc_num, _ in postings), default=0.0)
+            dictionary.append((term, t_freq, len(postings), offset, len(blob), max_inverse_length))
+            offset += len(blob)
+
+        dictionary_offset = offset
+        for term, t_freq, count, term_offset, size, max_inverse_length in dictionary:
+            encoded_term = term.encode("utf8")
+            postings_file.write(encode_varints([len(encoded_term)]) + encoded_term +
+                                encode_varints([t_freq, count, term_offset, size]) +
+                                BOUND.pack(max_inverse_length))
+        postings_file.seek(0)
+        postings_file.write(POSTINGS_HEADER.pack(POSTINGS_MAGIC, VERSION, len(documents),
+                                                 len(dictionary), dictionary_offset))
+
+    with open(path + ".docs", "wb") as documents_file:
+        documents_file.write(DOCUMENTS_HEADER.pack(DOCUMENTS_MAGIC, VERSION, len(documents),
+                                                   documents_fingerprint(document["_id"] for document in documents)))
+        documents_file.write(struct.pack("<%dd" % len(documents),
+                                         *[document.get("length", 0.0) for document in documents]))
+        records = [("\0".join([str(document["_id"]), document["title"] or "", document["url"]])).encode("utf8")
+                   for document in documents]
+        offsets = [0]
+        for record in records:
+            offsets.append(offsets[-1] + len(record))
+        documents_file.write(struct.pack("<%dQ" % len(offsets), *offsets))
+        documents_file.write(b"".join(records))
+
+
+class BinaryIndex:
+    '''
+    This class serves an inverted index written by write_binary_index. Both files are memory mapped,
+    so the posting lists and the document table are read directly from the page cache without any
+    database round trips. Only the term dictionary is loaded in memory.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.postings_file = open(path + ".idx", "rb")
+        self.postings = mmap.mmap(self.postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.documents_file = open(path + ".docs", "rb")
+        self.documents = mmap.mmap(self.documents_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.docs_count, num_terms, dictionary_offset = \
+            POSTINGS_HEADER.unpack_from(self.postings, 0)
+        if magic != POSTINGS_MAGIC or version != VERSION:
+            raise ValueError("{path}.idx is not a binary index file".format(path=path))
+        magic, version, docs_count, self.fingerprint = DOCUMENTS_HEADER.unpack_from(self.documents, 0)
+        if magic != DOCUMENTS_MAGIC or version != VERSION or docs_count != self.docs_count:
+            raise ValueError("{path}.docs is not the document table of the index".format(path=path))
+
+        # term -> (t_freq, number of postings, offset, size, maximum inverse document length)
+        self.dictionary = {}
+        offset = dictionary_offset
+        for _ in range(num_terms):
+            (term_size, ), offset = decode_varints(self.postings, offset, 1)
+            term = self.postings[offset:offset + term_size].decode("utf8")
+            offset += term_size
+            entry, offset = decode_varints(self.postings, offset, 4)
+            (max_inverse_length, ) = BOUND.unpack_from(self.postings, offset)
+            offset += BOUND.size
+            self.dictionary[term] = tuple(entry) + (max_inverse_length, )
+
+        self.lengths_offset = DOCUMENTS_HEADER.size
+        self.record_offsets_offset = self.lengths_offset + 8 * self.docs_count
+        self.records_offset = self.record_offsets_offset + 8 * (self.docs_count + 1)
+
+    def close(self):
+        self.postings.close()
+        self.postings_file.close()
+        self.documents.close()
+        self.documents_file.close()
+
+    def get_documents_count(self):
+        return self.docs_count
+
+    def term_frequency(self, term):
+        entry = self.dictionary.get(term)
+        return entry[0] if entry is not None else 0
+
+    def find_term(self, term):
+        '''
+        This method returns the term frequency of a term and its posting list as two lists of
+        document numbers and term-document frequencies, or None if the term is not in the index.
+        '''
+        entry = self.dictionary.get(term)
+        if entry is None:
+            return None
+        t_freq, count, offset, _, _ = entry
+        doc_nums, offset = decode_deltas(self.postings, offset, count)
+        t_d_freqs, _ = decode_varints(self.postings, offset, count)
+        return t_freq, doc_nums, t_d_freqs
+
+    def find_term_arrays(self, term):
+        '''
+        This method is the same as find_term, but returns the posting list as NumPy arrays
+        followed by the maximum inverse document length of the posting list.
+        '''
+        entry = self.dictionary.get(term)
+        if entry is None:
+            return None
+        t_freq, count, offset, size, max_inverse_length = entry
+        values = decode_varints_array(self.postings, offset, size)
+        return t_freq, np.cumsum(values[:count]), values[count:], max_inverse_length
+
+    def doc_lengths(self):
+        '''
+        This method returns the lengths of all the documents as a NumPy array backed by the memory map.
+        '''
+        return np.frombuffer(self.documents, dtype="<f8", count=self.docs_count, offset=self.lengths_offset)
+
+    def doc_length(self, doc_num):
+        return struct.unpack_from("<d", self.documents, self.lengths_offset + 8 * doc_num)[0]
+
+    def find_document(self, doc_num):
+        '''
+        This method returns the ID, title and url of a document number.
+        '''
+        start, end = struct.unpack_from("<QQ", self.documents, self.record_offsets_offset + 8 * doc_num)
+        record = self.documents[self.records_offset + start:self.records_offset + end].decode("utf8")
+        _id, record = record.split("\0", 1)
+        title, url = record.rsplit("\0", 1)
+        return {"_id": ObjectId(_id) if ObjectId.is_valid(_id) else _id, "title": title, "url": url}
@@ -0,0 +1,97 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def approximate_size(value):
+    '''
+    This function estimates the memory in bytes used by a value made of dicts, lists, tuples,
+    sets and scalars.
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class LRUCache:
+    '''
+    This class is a thread safe least recently used cache bounded by a number of entries and by the
+    approximate memory of its values. Entries expire ttl seconds after they were added if ttl is given.
+    The cache can be tied to a version, e.g. the generation of the index, and is emptied when it changes.
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None, sizeof=approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, size, expiry time)
+        self.bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[2] is not None and entry[2] < time.monotonic()):
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, expiry)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def check_version(self, version):
+        '''
+        This method empties the cache if version is different from the version of its entries.
+        '''
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
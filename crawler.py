@@ -1,32 +1,56 @@
-from bs4 import BeautifulSoup
-import nltk
-from nltk.stem import PorterStemmer
-import re
+import os
 import threading
 import time
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from urllib import request
+from analyzer import analyze_batch
+from executor import BoundedExecutor
+from frontier import Frontier, normalize_url
 from indexer import Indexer
+from metrics import registry as metrics
 from mongodb import MongoDB
+from segments import SegmentIndex
 import sys
 
 
 class Crawler:
-    def __init__(self, url: str, keep: bool, max_size: int, num_threads: int):
+    def __init__(self, url: str, keep: bool, max_size: int, num_threads: int, timeout: float = 10,
+                 state_dir: str = "crawler_state", checkpoint_every: int = 100,
+                 analysis_workers: int = os.cpu_count(), page_batch_size: int = 16, index_mode: str = "bulk",
+                 segment_path: str = None, db: MongoDB = None):
 
-        self.stop_words = set(nltk.corpus.stopwords.words("english"))
         self.crawled_pages = 0
         self.countLocker = threading.Lock()
-        self.urls = [url]
-        self.urlsLocker = threading.Lock()
-        self.threads_array = []
         self.num_threads = num_threads
-        self.db = MongoDB()
+        # A database can be given, e.g. to crawl into a test database
+        self.db = db if db is not None else MongoDB()
         self.max_size = max_size
+        self.timeout = timeout  # seconds to wait for a page
+        self.keep = keep
+        self.checkpoint_every = checkpoint_every  # crawled pages between two checkpoints of the frontier
+        # Downloaded pages are analyzed in batches by a pool of analysis_workers processes
+        self.analysis_workers = analysis_workers
+        self.page_batch_size = page_batch_size
+        self.index_mode = index_mode  # mode of the index build after a crawl without the previous data
+        # Saved pages are also flushed to a segment index, where they can be searched immediately
+        self.segments = SegmentIndex(segment_path) if segment_path is not None else None
+        self.pages = []
+        self.pagesLocker = threading.Lock()
+        self.pending_batches = 0
+        self.analysisDone = threading.Condition()
+        self.progress = 0  # downloads and analyzed batches finished, guarded by analysisDone
+        # Urls popped from the frontier whose pages were not saved, guarded by countLocker
+        self.unsaved_urls = []
         #If the user has selected to delete previous data and drop crawler database
         if keep == 0:
             self.db.reset_crawler()
-        self.indexer = Indexer(self.num_threads)
+        # Resume the urls to crawl from the last checkpoint if the previous data are kept
+        self.urls = Frontier(state_dir, resume=bool(keep))
+        if keep and not self.urls.resumed:
+            for record in self.db.crawler_db.find({}, {"url": 1}):
+                self.urls.mark_seen(record["url"])
+        self.urls.add(normalize_url(url, url) or url)
+        self.indexer = Indexer(self.num_threads, db=self.db)
 
     def crawl(self):
         '''
@@ -35,78 +59,158 @@ class Crawler:
         '''
         print("Crawling...")
         t1 = time.perf_counter()
-        while self.crawled_pages < self.max_size:
-            # Sleep when there are no available threads or there are no urls to crawl
-            while len(self.urls) == 0 or sum([1 for t in self.threads_array if t.is_alive()]) > self.num_threads:
-                time.sleep(0.5)
-                continue
-            #if there are no urls to crawl exit
-            if len(self.urls) == 0:
-                break
-            #Get next url
-            next_url = str(self.urls.pop(0))
-            #start new thread
-            t = threading.Thread(target=self.parse, args=(next_url))
-            t.start()
-            self.threads_array.append(t)
-
+        if self.segments is not None:
+            self.segments.start_merger()
+        with ProcessPoolExecutor(self.analysis_workers) as self.analysis_pool:
+            self.crawl_pages()
+            # Analyze and save the last downloaded pages
+            self.flush_pages()
+            with self.analysisDone:
+                self.analysisDone.wait_for(lambda: self.pending_batches == 0)
+        # The urls popped but not saved when the maximum number of pages was reached are crawled on resume
+        self.urls.requeue(self.unsaved_urls)
+        self.unsaved_urls = []
+        self.urls.checkpoint()
         t2 = time.perf_counter()
         print("Crawler total execution time: " +
               "{:.2f}".format(t2 - t1) + " secs")
-        self.indexer.create_index() #Build indexer after crawler finishes
+        metrics.print_summary("crawler_")
+        if self.segments is not None:
+            self.segments.stop_merger()
+            # The segments of a previous crawl are replaced only when the new crawl is complete
+            if not self.keep:
+                self.indexer.build_segments(self.segments)
+        #Build indexer after crawler finishes, indexing only the new pages if the previous data are kept
+        self.indexer.create_index(mode="incremental" if self.keep else self.index_mode)
+
+    def crawl_pages(self):
+        '''
+        This method downloads the pages using a pool of num_threads threads. Submitting a url waits while
+        the queue of the pool is full, and when there are no urls to crawl the method waits until a
+        download or the analysis of a batch finishes, since they are the only source of new urls.
+        '''
+        with BoundedExecutor(self.num_threads, max_queued=2 * self.num_threads, name="crawler") as downloads:
+            while self.crawled_pages < self.max_size:
+                with self.analysisDone:
+                    progress = self.progress
+                next_url = self.urls.pop()
+                if next_url is not None:
+                    downloads.submit(self.parse, next_url).add_done_callback(
+                        lambda future, url=next_url: self.download_done(future, url))
+                    continue
+                if len(downloads) == 0:
+                    # The links of the downloaded pages are the only source of new urls
+                    self.flush_pages()
+                    #if there are no urls to crawl and no pages to analyze exit
+                    with self.analysisDone:
+                        if self.pending_batches == 0 and len(self.urls) == 0:
+                            break
+                with self.analysisDone:
+                    self.analysisDone.wait_for(lambda: self.progress != progress, timeout=1.0)
+            # The urls queued when the maximum number of pages was reached are not downloaded
+            downloads.shutdown(cancel_futures=True)
+
+    def notify_progress(self, future=None):
+        with self.analysisDone:
+            self.progress += 1
+            self.analysisDone.notify_all()
+
+    def download_done(self, future, url):
+        if future.cancelled():
+            self.keep_unsaved([url])
+        self.notify_progress(future)
 
-        
-    def parse(self, *url_parse):
-        url = "".join(url_parse)
+    def keep_unsaved(self, urls):
+        '''
+        This method keeps urls popped from the frontier whose pages will not be saved, so that they are
+        put back in the frontier before its last checkpoint.
+        '''
+        with self.countLocker:
+            self.unsaved_urls.extend(urls)
+
+    def parse(self, url):
+        start = time.perf_counter()
         try:  # check if the reference is valid
-            html = request.urlopen(url).read().decode('utf8')
-            raw = BeautifulSoup(html, 'html.parser')
-            title = raw.title.string
+            html = request.urlopen(url, timeout=self.timeout).read().decode('utf8')
         except Exception:
+            metrics.inc("crawler_fetches_total", result="error")
             return
-        try:
-            links = []
-            # Find all new urls to other pages
-            for link in raw.findAll('a'):
-            
-                if link.get('href')[:4] == 'http':
-                    links.append(link.get('href'))
-                else:
-                    #if the link is links to the same page
-                    links.append(url+link.get('href'))
-            with self.urlsLocker:  # Add url links
-                self.urls += links
-
-            # If this record  exists in database return
-            if self.db.crawler_db.find_one({"title": title, "url": url}) != None:
+        finally:
+            metrics.observe("crawler_stage_seconds", time.perf_counter() - start, stage="fetch")
+        metrics.inc("crawler_fetches_total", result="ok")
+        self.submit_page(url, html)
+
+    def submit_page(self, url, html):
+        '''
+        This method hands a downloaded page to the analysis workers once a batch of pages is ready.
+        '''
+        with self.pagesLocker:
+            self.pages.append((url, html))
+            if len(self.pages) < self.page_batch_size:
                 return
+            batch = self.pages
+            self.pages = []
+        self.submit_batch(batch)
+
+    def flush_pages(self):
+        '''
+        This method hands the downloaded pages of an incomplete batch to the analysis workers.
+        '''
+        with self.pagesLocker:
+            batch = self.pages
+            self.pages = []
+        if batch:
+            self.submit_batch(batch)
+
+    def submit_batch(self, batch):
+        with self.analysisDone:
+            self.pending_batches += 1
+        submitted = time.perf_counter()
+        self.analysis_pool.submit(analyze_batch, batch).add_done_callback(
+            lambda future: self.save_batch(future, submitted))
 
-            rx = re.compile("[^\W\d_]+")  # regex for words
-            tokens = nltk.word_tokenize(raw.get_text())
-            all_words = [
-                word for word in tokens if word not in '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'] #exclude exclamation marks and special characters
-            all_words = [i[0] for i in [rx.findall(
-                i) for i in list(all_words)] if len(i) > 0]
-            all_words = [i for i in list(all_words) if not i.startswith("wg")]
-
-            # Remove the stop words from all_words
-            filtered_words = []
-            for w in all_words:
-                if w not in self.stop_words:
-                    filtered_words.append(w)
-            st = PorterStemmer()   # Stemming to all words
-            stemmed_words = [st.stem(word) for word in filtered_words]
-            # Convert all words to lowercase
-            lowercase_words = [word.lower() for word in stemmed_words]
-            with self.countLocker:  # Save the page information to the Database as a new document
-                if self.crawled_pages < self.max_size:
-                    print("Crawled {counter} documents of {total}...".format(counter=self.crawled_pages + 1,
+    def save_batch(self, future, submitted):
+        '''
+        This method adds the links of an analyzed batch of pages to the urls to crawl and saves
+        the new pages to the database with a single insert.
+        '''
+        start = time.perf_counter()
+        # Time from the submission of the batch until its analysis finished, including waiting for a worker
+        metrics.observe("crawler_stage_seconds", start - submitted, stage="analysis")
+        try:
+            pages = [page for page in future.result() if page is not None]
+            for page in pages:
+                for link_url in page.pop("links"):
+                    self.urls.add(link_url)
+
+            # Pages that exist in database are not saved again
+            existing = set((record["title"], record["url"]) for record in
+                           self.db.crawler_db.find({"url": {"$in": [page["url"] for page in pages]}},
+                                                   {"title": 1, "url": 1}))
+            pages = [page for page in pages if (page["title"], page["url"]) not in existing]
+            with self.countLocker:  # Save the page information to the Database as new documents
+                limit = max(0, self.max_size - self.crawled_pages)
+                self.unsaved_urls.extend(page["url"] for page in pages[limit:])
+                pages = pages[:limit]
+                if pages:
+                    self.db.crawler_db.insert_many(pages)
+                    metrics.inc("crawler_pages_saved_total", len(pages))
+                    previous = self.crawled_pages
+                    self.crawled_pages += len(pages)
+                    print("Crawled {counter} documents of {total}...".format(counter=self.crawled_pages,
                                                                              total=self.max_size))
-                    self.db.crawler_db.insert_one(
-                        {"url": url, "title": title, "bag": Counter(lowercase_words)})
-                    self.crawled_pages += 1
+                    if previous // self.checkpoint_every != self.crawled_pages // self.checkpoint_every:
+                        self.urls.checkpoint()
+            if pages and self.segments is not None:
+                self.segments.flush(pages)
         except Exception:  # something went wrong during this phase, so we will not have any results
-            return
+            pass
+        finally:
+            metrics.observe("crawler_stage_seconds", time.perf_counter() - start, stage="save")
+            with self.analysisDone:
+                self.pending_batches -= 1
+                self.progress += 1
+                self.analysisDone.notify_all()
 
 
 if __name__ == "__main__":
@@ -114,11 +218,23 @@ if __name__ == "__main__":
     size = int(sys.argv[2])
     keep_data = int(sys.argv[3])
     threads = int(sys.argv[4])
+    # Optional crawl mode: "threads" (default) or "async"
+    mode = str(sys.argv[5]) if len(sys.argv) > 5 else "threads"
+    # Optional index mode after a crawl without the previous data and segment index path
+    index_mode = str(sys.argv[6]) if len(sys.argv) > 6 else "bulk"
+    segment_path = str(sys.argv[7]) if len(sys.argv) > 7 else None
+    if mode == "async":
+        from async_crawler import AsyncCrawler
+        crawler_class = AsyncCrawler
+    else:
+        crawler_class = Crawler
     if keep_data == 0:
-        crawler = Crawler(url=url,
-                          keep=False, max_size=size, num_threads=threads)
+        crawler = crawler_class(url=url,
+                                keep=False, max_size=size, num_threads=threads,
+                                index_mode=index_mode, segment_path=segment_path)
     else:
-        crawler = Crawler(url=url, keep=True,
-                          max_size=size, num_threads=threads)
+        crawler = crawler_class(url=url, keep=True,
+                                max_size=size, num_threads=threads,
+                                index_mode=index_mode, segment_path=segment_path)
 
     crawler.crawl()
@@ -0,0 +1,112 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class BoundedExecutor:
+    '''
+    This class runs tasks on a fixed number of worker threads that take them from a bounded work queue.
+    Submitting a task blocks while the queue is full, so a fast producer cannot queue unbounded work, and
+    every task returns a Future. join waits until all the submitted tasks have finished, without polling,
+    and raises the first exception raised by a task, so that tasks whose futures are not kept do not
+    fail silently.
+    '''
+
+    def __init__(self, max_workers, max_queued=None, name="worker"):
+        self.max_workers = max(1, max_workers)
+        self.tasks = queue.Queue(maxsize=max_queued if max_queued is not None else 2 * self.max_workers)
+        self.pending = 0  # submitted tasks that have not finished
+        self.idle = threading.Condition()
+        self.error = None
+        self.stopped = False
+        self.workers = [threading.Thread(target=self.work, name="{name}-{number}".format(name=name, number=i),
+                                         daemon=True)
+                        for i in range(self.max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def __len__(self):
+        '''
+        This method returns the number of submitted tasks that have not finished.
+        '''
+        with self.idle:
+            return self.pending
+
+    def submit(self, function, *args, **kwargs):
+        if self.stopped:
+            raise RuntimeError("cannot submit tasks after shutdown")
+        future = Future()
+        with self.idle:
+            self.pending += 1
+        self.tasks.put((future, function, args, kwargs))
+        return future
+
+    def map(self, function, *iterables):
+        '''
+        This method runs function on every item of the iterables and returns the results in order.
+        '''
+        futures = [self.submit(function, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, function, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except BaseException as error:
+                    future.set_exception(error)
+                    with self.idle:
+                        if self.error is None:
+                            self.error = error
+            with self.idle:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.idle.notify_all()
+
+    def join(self, timeout=None):
+        '''
+        This method waits until all the submitted tasks have finished and returns True, or False if
+        timeout seconds passed first. It raises the first exception raised by a task since the last join.
+        '''
+        with self.idle:
+            finished = self.idle.wait_for(lambda: self.pending == 0, timeout)
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return finished
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        '''
+        This method stops the workers after they finish the queued tasks, or cancels the queued tasks
+        that have not started if cancel_futures is True.
+        '''
+        if self.stopped:
+            return
+        self.stopped = True
+        if cancel_futures:
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[0].cancel()
+                    with self.idle:
+                        self.pending -= 1
+                        if self.pending == 0:
+                            self.idle.notify_all()
+        for _ in self.workers:
+            self.tasks.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+from collections import deque
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(base, href):
+    '''
+    This function resolves a link found in the page base to an absolute url without fragment,
+    with lowercase scheme and host and without the default port. It returns None for links
+    that are not http(s) urls.
+    '''
+    if not href:
+        return None
+    try:
+        url, _ = urldefrag(urljoin(base, href.strip()))
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS or not parts.hostname:
+            return None
+        netloc = parts.hostname.lower()
+        if parts.port is not None and parts.port != DEFAULT_PORTS[scheme]:
+            netloc += ":{port}".format(port=parts.port)
+    except ValueError:
+        return None
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+class BloomFilter:
+    '''
+    This class is a Bloom filter of strings. It never forgets an added string and wrongly reports
+    a string as added with probability error_rate when it holds capacity strings.
+    '''
+    HEADER = struct.Struct("<QII")  # number of bits, number of hashes, number of added strings
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as bloom_file:
+            bloom_file.write(self.HEADER.pack(self.num_bits, self.num_hashes, self.count))
+            bloom_file.write(self.bits)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        bloom = cls.__new__(cls)
+        with open(path, "rb") as bloom_file:
+            bloom.num_bits, bloom.num_hashes, bloom.count = cls.HEADER.unpack(bloom_file.read(cls.HEADER.size))
+            bloom.bits = bytearray(bloom_file.read())
+        return bloom
+
+
+class Frontier:
+    '''
+    This class is the queue of the urls to crawl. Urls are crawled in breadth first order and every
+    url is added only once, using a Bloom filter of the urls seen so far. At most max_in_memory urls are
+    kept in memory and the rest are spilled to files in state_dir. A checkpoint saves the queue and the
+    seen urls to state_dir, so that a crawl can resume from it without fetching the same pages again.
+    '''
+    STATE = "frontier.json"
+    SEEN = "seen.bloom"
+
+    def __init__(self, state_dir, resume=False, max_in_memory=100000, spill_size=10000,
+                 capacity=1000000, error_rate=0.001):
+        self.state_dir = state_dir
+        self.max_in_memory = max_in_memory
+        self.spill_size = spill_size  # urls per spill file
+        self.lock = threading.Lock()
+        os.makedirs(state_dir, exist_ok=True)
+        # Urls in crawl order: head, spilled files (oldest first), tail
+        self.head = deque()
+        self.spilled = deque()
+        self.tail = []
+        self.spilled_urls = 0
+        self.next_spill = 0
+        self.consumed = []  # spill files read since the last checkpoint, still needed to resume from it
+        self.resumed = resume and os.path.exists(self.path(self.STATE))
+        if self.resumed:
+            self.load()
+        else:
+            self.clear()
+            self.seen = BloomFilter(capacity, error_rate)
+
+    def path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def __len__(self):
+        return len(self.head) + self.spilled_urls + len(self.tail)
+
+    def add(self, url):
+        '''
+        This method adds a url to the queue if it has not been seen before and returns True if it was added.
+        '''
+        with self.lock:
+            if url in self.seen:
+                return False
+            self.seen.add(url)
+            if not self.spilled and not self.tail and len(self.head) < self.max_in_memory:
+                self.head.append(url)
+            else:
+                self.tail.append(url)
+                if len(self.tail) >= self.spill_size:
+                    self.spill()
+            return True
+
+    def mark_seen(self, url):
+        '''
+        This method marks a url as seen without adding it to the queue.
+        '''
+        with self.lock:
+            self.seen.add(url)
+
+    def requeue(self, urls):
+        '''
+        This method puts urls that were popped but not crawled back at the front of the queue, in the
+        given order. The urls are already in the Bloom filter, so they are not checked against it.
+        '''
+        with self.lock:
+            self.head.extendleft(reversed(list(urls)))
+
+    def pop(self):
+        '''
+        This method removes and returns the next url to crawl, or None if the queue is empty.
+        '''
+        with self.lock:
+            if not self.head:
+                self.refill()
+            return self.head.popleft() if self.head else None
+
+    def spill(self):
+        name = "spill-{number}.txt".format(number=self.next_spill)
+        self.next_spill += 1
+        with open(self.path(name), "w", encoding="utf8") as spill_file:
+            spill_file.write("\n".join(self.tail) + "\n")
+        self.spilled.append((name, len(self.tail)))
+        self.spilled_urls += len(self.tail)
+        self.tail = []
+
+    def refill(self):
+        if self.spilled:
+            name, count = self.spilled.popleft()
+            self.head.extend(self.read_urls(name))
+            self.spilled_urls -= count
+            self.consumed.append(name)
+        else:
+            self.head.extend(self.tail)
+            self.tail = []
+
+    def read_urls(self, name):
+        with open(self.path(name), encoding="utf8") as urls_file:
+            return [line.rstrip("\n") for line in urls_file if line.strip()]
+
+    def checkpoint(self):
+        '''
+        This method saves the queue and the seen urls to the state directory. The queue is replaced
+        with a single rename, so an interrupted checkpoint leaves the previous queue usable.
+        '''
+        with self.lock:
+            self.seen.save(self.path(self.SEEN))
+            with open(self.path(self.STATE) + ".tmp", "w", encoding="utf8") as state_file:
+                json.dump({"head": list(self.head), "spilled": list(self.spilled), "tail": self.tail,
+                           "next_spill": self.next_spill}, state_file)
+            os.replace(self.path(self.STATE) + ".tmp", self.path(self.STATE))
+            for name in self.consumed:
+                os.remove(self.path(name))
+            self.consumed = []
+
+    def load(self):
+        with open(self.path(self.STATE), encoding="utf8") as state_file:
+            state = json.load(state_file)
+        self.spilled = deque((name, count) for name, count in state["spilled"])
+        self.spilled_urls = sum(count for _, count in self.spilled)
+        self.next_spill = state["next_spill"]
+        self.head = deque(state["head"])
+        self.tail = state["tail"]
+        self.seen = BloomFilter.load(self.path(self.SEEN))
+
+    def clear(self):
+        '''
+        This method deletes the saved state of a previous crawl.
+        '''
+        for name in os.listdir(self.state_dir):
+            if name in (self.STATE, self.SEEN) or name.startswith("spill-"):
+                os.remove(self.path(name))
@@ -1,63 +1,462 @@
+import heapq
 import math
+import os
+import pickle
+import shutil
+import sys
+import tempfile
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 
+from binary_index import documents_fingerprint, write_binary_index
+from executor import BoundedExecutor
+from metrics import registry as metrics
 from mongodb import MongoDB
+from positional_index import write_positional_index
+from snapshot import SnapshotStore
+from scoring import document_length, squared_weight
+
+
+def write_run(postings, directory):
+    '''
+    This function writes a sorted run of postings (term -> list of document postings) to a
+    temporary file and returns its path. Runs are used to spill postings to disk when they
+    do not fit in the memory budget of the indexer.
+    '''
+    fd, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(fd, "wb") as run:
+        for term in sorted(postings):
+            pickle.dump((term, postings[term]), run, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_run(path):
+    '''
+    This function yields the (term, postings) records of a run file in term order.
+    '''
+    with open(path, "rb") as run:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+
+def merge_runs(paths):
+    '''
+    This function merges sorted run files with a k-way merge and yields every term once
+    with the concatenation of its postings. Runs must be given in document order, so that
+    the merged posting lists keep the order of the documents.
+    '''
+    def numbered_run(i, path):
+        for term, documents in read_run(path):
+            yield term, i, documents
+
+    runs = [numbered_run(i, path) for i, path in enumerate(paths)]
+    current_term = None
+    current_documents = []
+    for term, _, documents in heapq.merge(*runs, key=lambda entry: entry[:2]):
+        if term != current_term:
+            if current_term is not None:
+                yield current_term, current_documents
+            current_term = term
+            current_documents = []
+        current_documents.extend(documents)
+    if current_term is not None:
+        yield current_term, current_documents
+
+
+def index_posting(doc_num, document, t_d_freq):
+    return {"_id": document["_id"], "title": document["title"], "url": document["url"], "t_d_freq": t_d_freq}
+
+
+def segment_posting(doc_num, document, t_d_freq):
+    return doc_num, t_d_freq
+
+
+def aggregate_postings(documents, run_directory, max_postings_in_memory, posting=index_posting):
+    '''
+    This function aggregates the postings of documents sorted by ID into posting lists in memory,
+    spilling them to sorted run files in run_directory when they exceed max_postings_in_memory.
+    posting(document number, document, t_d_freq) returns the posting of a term of a document, a
+    posting of the inverted index by default. It returns the paths of the runs in document order
+    and the postings that were not spilled.
+    '''
+    runs = []
+    postings = {}
+    buffered = 0
+    for doc_num, document in enumerate(documents):
+        for term, t_d_freq in document["bag"].items():
+            postings.setdefault(term.lower(), []).append(posting(doc_num, document, t_d_freq))
+        buffered += len(document["bag"])
+        # Spill the postings to disk when they do not fit in memory
+        if buffered >= max_postings_in_memory:
+            metrics.inc("index_runs_spilled_total")
+            runs.append(write_run(postings, run_directory))
+            postings = {}
+            buffered = 0
+    return runs, postings
+
+
+def build_shard(lower, upper, run_directory, max_postings_in_memory, host, database):
+    '''
+    This function builds the sorted posting runs of the documents with ID from lower to upper
+    (see MongoDB.find_documents_in_range) in a worker process of the sharded build. Every worker
+    opens its own connection to the database of the indexer, given by its host and name. It returns
+    the paths of the runs in document order.
+    '''
+    db = MongoDB(host=host, database=database)
+    runs, postings = aggregate_postings(db.find_documents_in_range(lower, upper), run_directory,
+                                        max_postings_in_memory)
+    if postings:
+        runs.append(write_run(postings, run_directory))
+    return runs
+
+
+def chunks(items, size):
+    '''
+    This function splits a list of items into consecutive lists of at most size items.
+    '''
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 class Indexer:
 
-    def __init__(self, num_threads_array=2):
-        self.thread_array = []
+    def __init__(self, num_threads_array=2, max_postings_in_memory=2000000, batch_size=1000, db=None,
+                 shards=os.cpu_count()):
         self.index = {}
         self.num_threads = num_threads_array
-        self.db = MongoDB()
+        # Locks of the terms of the threaded build, a term uses the lock of its hash
+        self.term_lockers = [threading.Lock() for _ in range(4 * max(1, num_threads_array))]
+        self.max_postings_in_memory = max_postings_in_memory  # spill postings to disk above this
+        self.batch_size = batch_size  # number of index entries written per round trip
+        self.shards = shards  # worker processes of the sharded build
+        self.db = db if db is not None else MongoDB()
 
-    def create_index(self):
+    def create_index(self, mode="bulk"):
         '''
-        This method builds the inverted index 
+        This method builds the inverted index. In "bulk" mode the documents are read once and
+        the postings are aggregated in memory and written in batches, while in "threaded" mode
+        every term of every document is added to the index by a separate thread. In "sharded" mode
+        the documents are split in ID ranges whose postings are aggregated by parallel processes.
+        In "incremental" mode the existing index is kept and only the new crawled documents are indexed.
         '''
         print("Creating inverted index...")
         t1 = time.perf_counter()
-        self.db.reset_indexer()
-        self.db.build_documents_db()
-        # Get the documents total count
-        self.docs_count = self.db.get_documents_count()
-        # Get all document IDs from the database
-        self.doc_ids = self.db.find_document_ids()
-
-        for doc_id in self.doc_ids:
-            document = self.db.find_document_by_id(doc_id)
-            bag = document["bag"]
-            for term in bag:
-                while sum([1 for t in self.thread_array if t.is_alive()]) > self.num_threads:
-                    time.sleep(0.5)
-                new_task = threading.Thread(
-                    target=self.process_term, args=(document, term))
-                new_task.start()
-                self.thread_array.append(new_task)
-        #Wait all threads to finish
-        while sum([1 for t in self.thread_array if t.is_alive()]) > 0:
-            time.sleep(0.5)
-
-        self.thread_array = []
-
-        for _id in self.doc_ids:
-
-            document = self.db.find_document_by_id(_id)
-            while sum([1 for t in self.thread_array if t.is_alive()]) > self.num_threads:
-                time.sleep(0.5)
-
-            new_task = threading.Thread(
-                target=self.calculate_doc_length, args=(document, ))
-            new_task.start()
-            self.thread_array.append(new_task)
-        #Wait all threads to finish
-        while sum([1 for t in self.thread_array if t.is_alive()]) > 0:
-            time.sleep(0.5)
+        if mode == "incremental":
+            with metrics.timer("index_phase_seconds", phase="incremental"):
+                self.incremental_build()
+            self.db.bump_index_generation()
+            t2 = time.perf_counter()
+            metrics.observe("index_build_seconds", t2 - t1, mode=mode)
+            print("Inverted Index is successfully updated. Total time {total}...".format(
+                total=t2-t1))
+            metrics.print_summary("index_", "mongodb_")
+            return
+
+        with metrics.timer("index_phase_seconds", phase="documents"):
+            self.db.reset_indexer()
+            self.db.build_documents_db()
+            # Get the documents total count
+            self.docs_count = self.db.get_documents_count()
+            # Get all document IDs from the database
+            self.doc_ids = self.db.find_document_ids()
+
+        with metrics.timer("index_phase_seconds", phase="postings"):
+            if mode == "bulk":
+                self.bulk_build()
+            elif mode == "sharded":
+                self.sharded_build()
+            else:
+                self.threaded_build()
+
+        with metrics.timer("index_phase_seconds", phase="doc_lengths"):
+            lengths = self.calculate_doc_lengths()
+        with metrics.timer("index_phase_seconds", phase="upper_bounds"):
+            self.update_upper_bounds(lengths=lengths)
+        self.db.bump_index_generation()
         t2 = time.perf_counter()
+        metrics.observe("index_build_seconds", t2 - t1, mode=mode)
         print("Inverted Index is successfully created. Total time {total}...".format(
             total=t2-t1))
+        metrics.print_summary("index_", "mongodb_")
+
+    def threaded_build(self):
+        '''
+        This method adds every term of every document to the inverted index as a separate task of a
+        pool of num_threads threads. The (document, term) pairs of the same term are serialized with
+        a striped lock, so that a new term is never added to the index twice.
+        '''
+        with BoundedExecutor(self.num_threads, max_queued=4 * self.num_threads, name="indexer") as executor:
+            for doc_id in self.doc_ids:
+                document = self.db.find_document_by_id(doc_id)
+                bag = document["bag"]
+                for term in bag:
+                    executor.submit(self.process_term, document, term)
+            #Wait all tasks to finish
+            executor.join()
+
+    def bulk_build(self):
+        '''
+        This method builds the inverted index reading the documents only once. The postings of
+        every term are aggregated in memory and spilled to sorted run files when they exceed
+        max_postings_in_memory. The terms are then written to the index in batches.
+        '''
+        run_directory = tempfile.mkdtemp(prefix="indexer-")
+        try:
+            runs, postings = aggregate_postings(self.db.find_all_documents(), run_directory,
+                                                self.max_postings_in_memory)
+            if runs:
+                if postings:
+                    runs.append(write_run(postings, run_directory))
+                    postings = {}
+                terms = merge_runs(runs)
+            else:
+                terms = ((term, postings[term]) for term in sorted(postings))
+            self.write_terms(terms)
+        finally:
+            shutil.rmtree(run_directory)
+
+    def sharded_build(self):
+        '''
+        This method builds the inverted index splitting the documents in shards of consecutive IDs.
+        A pool of processes builds the sorted posting runs of every shard, sharing the memory budget
+        of the indexer, and the runs of all the shards are merged with a k-way merge in document
+        order and written to the index in batches.
+        '''
+        doc_ids = sorted(self.doc_ids)
+        if not doc_ids:
+            self.write_terms([])
+            return
+        shards = min(self.shards, len(doc_ids))
+        # The lower bound of every shard and no upper bound for the last one
+        bounds = [doc_ids[len(doc_ids) * i // shards] for i in range(shards)] + [None]
+
+        run_directory = tempfile.mkdtemp(prefix="indexer-")
+        try:
+            runs = []
+            with ProcessPoolExecutor(shards) as pool:
+                shard_runs = [pool.submit(build_shard, bounds[i], bounds[i + 1], run_directory,
+                                          max(1, self.max_postings_in_memory // shards), self.db.host,
+                                          self.db.database)
+                              for i in range(shards)]
+                # The runs of the shards in shard order are in document order
+                for future in shard_runs:
+                    runs.extend(future.result())
+            print("Merging {count} runs of {shards} shards...".format(count=len(runs), shards=shards))
+            self.write_terms(merge_runs(runs))
+        finally:
+            shutil.rmtree(run_directory)
+
+    def write_terms(self, terms):
+        '''
+        This method writes (term, postings) pairs to the inverted index in batches of batch_size entries.
+        '''
+        batch = []
+        for term, documents in terms:
+            batch.append({"term": term,
+                          "t_freq": len(documents),
+                          "documents": documents})
+            if len(batch) >= self.batch_size:
+                self.db.add_many_to_indexer(batch)
+                batch = []
+        self.db.add_many_to_indexer(batch)
+        self.db.create_term_index()
+
+    def incremental_build(self):
+        '''
+        This method indexes only the crawled documents that are not yet in the documents database.
+        Their postings are appended to the existing terms of the index and the lengths of the new
+        documents and of the documents that share a term with them are recomputed. The lengths of
+        the other documents keep the corpus size of their last computation until a full rebuild.
+        '''
+        indexed_ids = set(self.db.find_document_ids())
+        new_ids = sorted(_id for _id in self.db.find_crawler_record_ids() if _id not in indexed_ids)
+        print("Indexing {count} new documents...".format(count=len(new_ids)))
+        if not new_ids:
+            return
+
+        touched_terms = set()
+        for batch in chunks(new_ids, self.batch_size):
+            documents = sorted(self.db.find_crawler_records_by_ids(batch), key=lambda d: d["_id"])
+            self.db.add_documents(documents)
+            postings = {}
+            for document in documents:
+                for term, t_d_freq in document["bag"].items():
+                    postings.setdefault(term.lower(), []).append({"_id": document["_id"],
+                                                                  "title": document["title"],
+                                                                  "url": document["url"],
+                                                                  "t_d_freq": t_d_freq})
+            self.db.append_to_indexer(postings)
+            touched_terms.update(postings)
+        self.db.create_term_index()
+
+        self.docs_count = self.db.get_documents_count()
+        # Only the documents that contain a term with a changed term frequency are affected
+        affected_ids = set(new_ids)
+        for terms in chunks(touched_terms, self.batch_size):
+            affected_ids.update(self.db.find_documents_containing(terms))
+        changed_terms = self.update_doc_lengths(affected_ids)
+        self.update_upper_bounds(changed_terms)
+
+    def update_doc_lengths(self, doc_ids):
+        '''
+        This method recomputes the length of the given documents in batches, fetching the term
+        frequencies of all the words of a batch with a single query. It returns the words of the documents,
+        which are the terms whose posting lists contain a document with a changed length.
+        '''
+        changed_terms = set()
+        for batch in chunks(doc_ids, self.batch_size):
+            documents = list(self.db.find_documents_by_ids(batch, {"bag": 1}))
+            words = set()
+            for document in documents:
+                words.update(document["bag"])
+            term_frequencies = {}
+            for terms in chunks(words, self.batch_size):
+                term_frequencies.update(self.db.find_term_frequencies(terms))
+            self.db.add_doc_norms({document["_id"]: (document_length(document["bag"], term_frequencies,
+                                                                     self.docs_count),
+                                                     max(document["bag"].values(), default=0))
+                                   for document in documents})
+            changed_terms.update(words)
+        return changed_terms
+
+    def calculate_doc_lengths(self):
+        '''
+        This method calculates the length and the maximum term-document frequency of all the documents
+        in a single pass over the posting lists of the index. The squared weight of a term depends only
+        on its term frequency, so it is added to every document of its posting list. The results are
+        written with a bulk write per batch of documents and the lengths are returned.
+        '''
+        squared_weights_sums = {}
+        max_t_d_freqs = {}
+        for entry in self.db.find_all_terms():
+            weight = squared_weight(entry["t_freq"], self.docs_count)
+            for posting in entry["documents"]:
+                doc_id = posting["_id"]
+                squared_weights_sums[doc_id] = squared_weights_sums.get(doc_id, 0) + weight
+                if posting["t_d_freq"] > max_t_d_freqs.get(doc_id, 0):
+                    max_t_d_freqs[doc_id] = posting["t_d_freq"]
+
+        lengths = {doc_id: math.sqrt(squared_weights_sums.get(doc_id, 0)) for doc_id in self.doc_ids}
+        for batch in chunks(self.doc_ids, self.batch_size):
+            self.db.add_doc_norms({doc_id: (lengths[doc_id], max_t_d_freqs.get(doc_id, 0)) for doc_id in batch})
+        return lengths
+
+    def update_upper_bounds(self, terms=None, lengths=None):
+        '''
+        This method stores for every term (or only for the given terms) the maximum inverse length
+        of the documents of its posting list, from which the Query Handler calculates the upper bound
+        of the score of the term. The document lengths are read from the database if they are not given.
+        '''
+        if lengths is None:
+            lengths = {document["_id"]: document.get("length", 0.0) for document in self.db.find_document_table()}
+        inverse_lengths = {doc_id: 1.0 / length if length > 0 else 1.0 for doc_id, length in lengths.items()}
+        if terms is None:
+            batches = [self.db.find_all_terms()]
+        else:
+            batches = (self.db.find_terms_postings(batch) for batch in chunks(terms, self.batch_size))
+        for entries in batches:
+            bounds = {}
+            for entry in entries:
+                bounds[entry["term"]] = max(inverse_lengths[posting["_id"]] for posting in entry["documents"])
+                if len(bounds) >= self.batch_size:
+                    self.db.add_term_upper_bounds(bounds)
+                    bounds = {}
+            self.db.add_term_upper_bounds(bounds)
+
+    def build_segments(self, segments):
+        '''
+        This method replaces the segments of a SegmentIndex with a single segment of all the crawled
+        documents. The previous segments are searched until the new one is complete. Only the bags of
+        words of the documents are read, and their postings are spilled to sorted run files like in
+        bulk_build, so the rebuild keeps the memory budget of the indexer.
+        '''
+        print("Building segment index in {directory}...".format(directory=segments.directory))
+        documents = []
+
+        def records():
+            for record in self.db.find_crawler_bags():
+                documents.append({"_id": record["_id"], "title": record["title"], "url": record["url"]})
+                yield record
+
+        run_directory = tempfile.mkdtemp(prefix="indexer-")
+        try:
+            runs, postings = aggregate_postings(records(), run_directory, self.max_postings_in_memory,
+                                                segment_posting)
+            if postings:
+                runs.append(write_run(postings, run_directory))
+            # The runs are merged twice, once for the document lengths and once to write the postings
+            segments.rebuild(documents, lambda: merge_runs(runs))
+        finally:
+            shutil.rmtree(run_directory)
+
+    def export_binary_index(self, path):
+        '''
+        This method exports the inverted index and the documents table in the compact binary format
+        of binary_index, so that the Query Handler can serve queries from files without database round trips.
+        '''
+        print("Exporting inverted index to {path}...".format(path=path))
+        documents = list(self.db.find_document_table())
+        doc_nums = {document["_id"]: doc_num for doc_num, document in enumerate(documents)}
+        terms = ((entry["term"], entry["t_freq"],
+                  [(doc_nums[posting["_id"]], posting["t_d_freq"]) for posting in entry["documents"]])
+                 for entry in self.db.find_all_terms())
+        write_binary_index(path, documents, terms)
+
+    def export_positional_index(self, path):
+        '''
+        This method exports the positions of the terms of every document as a positional index in
+        path.pos, used by the Query Handler for phrase and proximity queries. The documents are numbered
+        like the document table, so the positional index must be exported whenever the index is rebuilt,
+        and the fingerprint of the document IDs in its header tells the Query Handler if it is outdated.
+        Documents crawled before the positions were recorded have no positions. Like the postings of
+        bulk_build, the positions are spilled to sorted run files when they exceed max_postings_in_memory
+        and the runs are merged in term order.
+        '''
+        print("Exporting positional index to {path}.pos...".format(path=path))
+        run_directory = tempfile.mkdtemp(prefix="indexer-")
+        try:
+            runs = []
+            postings = {}
+            buffered = 0
+            doc_ids = []
+            for doc_num, document in enumerate(self.db.find_all_documents()):
+                doc_ids.append(document["_id"])
+                for term, positions in document.get("positions", {}).items():
+                    postings.setdefault(term.lower(), []).append((doc_num, positions))
+                    buffered += len(positions)
+                if buffered >= self.max_postings_in_memory:
+                    metrics.inc("index_runs_spilled_total")
+                    runs.append(write_run(postings, run_directory))
+                    postings = {}
+                    buffered = 0
+            if runs:
+                if postings:
+                    runs.append(write_run(postings, run_directory))
+                    postings = {}
+                terms = merge_runs(runs)
+            else:
+                terms = ((term, postings[term]) for term in sorted(postings))
+            write_positional_index(path, len(doc_ids), documents_fingerprint(doc_ids), terms)
+        finally:
+            shutil.rmtree(run_directory)
+
+    def export_snapshot(self, directory):
+        '''
+        This method publishes the inverted index, the documents table and the positional index as a new
+        version of the SnapshotStore in directory. Query servers that use the store start serving it on
+        their next query, ranking and returning results without reading the database.
+        '''
+        def export(path):
+            self.export_binary_index(path)
+            self.export_positional_index(path)
+
+        generation = SnapshotStore(directory).publish(export)
+        print("Published snapshot {generation} in {directory}".format(generation=generation, directory=directory))
+        return generation
 
     def process_term(self, document, term):
         '''
@@ -68,62 +467,34 @@ class Indexer:
         title = document["title"]
         bag = document["bag"]
 
-        # Check if the term already exists in the inverted index and update the database
-        if self.db.find_term_in_index(term):
-           
-            self.db.update_indexer(term, {"_id": id,
-                                          "title": title,
-                                          "url": url,
-                                          "t_d_freq": bag[term]
-                                          })
-        else:
-            # If the term does not exist in the index, add it to the database
-            self.db.add_to_indexer({"term": term.lower(),
-                                    "t_freq": 1,
-                                    "documents": [{"_id": id,
-                                                   "title": title,
-                                                   "url": url,
-                                                   "t_d_freq": bag[term]}]
-                                    })
+        with self.term_lockers[hash(term) % len(self.term_lockers)]:
+            # Check if the term already exists in the inverted index and update the database
+            if self.db.find_term_in_index(term):
 
-    def calculate_doc_length(self, document):
-        '''
-        This method is used to calculate the document length
-        '''
-        doc_id = document["_id"]
-        bag = document["bag"]
-        # Initialize the score accumulator for the current document to 0
-        squared_weights_sum = 0
-
-        # Find maximum term-document frequency value for this document
-        max_t_d_freq = 1
-        for word in bag:
-            term = self.db.find_term_in_index(word)
-            t_d_freq = 0
-            for document in term["documents"]:
-                if document["_id"] == doc_id:
-                    t_d_freq = document["t_d_freq"]
-
-            if t_d_freq > max_t_d_freq:
-                max_t_d_freq = t_d_freq
-        # for every word in the bag of the document calculate normalized tf-idf weight
-        for word in bag:
-            term = self.db.find_term_in_index(word)
-            t_d_freq = 0
-            for document in term["documents"]:
-                if document["_id"] == doc_id:
-                    t_d_freq = document["t_d_freq"]
-            tf = term["t_freq"]
-
-            norm_t_d_freq = t_d_freq / max_t_d_freq
-            
-            nidf = math.log(self.docs_count / tf) / \
-                math.log(self.docs_count)
-            
-
-            squared_weights_sum += math.pow(nidf * nidf, 2)
-
-        # Calculate document's length and add it to dictionary.
-        length = math.sqrt(squared_weights_sum)
-
-        self.db.add_doc_length(doc_id, length)
+                self.db.update_indexer(term, {"_id": id,
+                                              "title": title,
+                                              "url": url,
+                                              "t_d_freq": bag[term]
+                                              })
+            else:
+                # If the term does not exist in the index, add it to the database
+                self.db.add_to_indexer({"term": term.lower(),
+                                        "t_freq": 1,
+                                        "documents": [{"_id": id,
+                                                       "title": title,
+                                                       "url": url,
+                                                       "t_d_freq": bag[term]}]
+                                        })
+
+
+if __name__ == "__main__":
+    # Export the inverted index of the database to the binary index files given from commandline,
+    # and the positional index too if the second argument is "positions", or publish a new snapshot
+    # of the index in a snapshot directory with: python indexer.py snapshot directory
+    indexer = Indexer()
+    if sys.argv[1] == "snapshot":
+        indexer.export_snapshot(str(sys.argv[2]))
+    else:
+        indexer.export_binary_index(str(sys.argv[1]))
+        if len(sys.argv) > 2 and sys.argv[2] == "positions":
+            indexer.export_positional_index(str(sys.argv[1]))
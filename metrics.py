@@ -0,0 +1,193 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''
+    This class counts observed values in cumulative buckets, like a Prometheus histogram,
+    and also keeps their sum and maximum.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # observations in every bucket, not cumulative
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    values = ",".join('{name}="{value}"'.format(
+        name=name, value=str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+    return "{" + values + "}"
+
+
+class MetricsRegistry:
+    '''
+    This class collects the counters and the latency histograms of a process. Every metric is identified
+    by its name and its labels, e.g. the method of a database call or the phase of a query. The metrics
+    can be rendered in the Prometheus text format or summarized at the end of a crawl or index build.
+    Metrics are per process: every worker process of a WSGI server reports its own.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        This context manager adds the seconds spent in its block to the histogram name.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        '''
+        This decorator adds the seconds spent in every call of a function to the histogram name,
+        labeled with the name of the function as method.
+        '''
+        def decorator(function):
+            method_labels = dict(labels, method=function.__name__)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **method_labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iterator(self, name, **labels):
+        '''
+        This decorator is like timed for functions that return a lazy iterator, such as a database cursor,
+        whose work is done while it is iterated. The seconds spent in the call and in every step of the
+        iteration, but not in the caller between the steps, are added to the histogram name as one
+        observation when the iteration ends.
+        '''
+        def decorator(function):
+            method_labels = dict(labels, method=function.__name__)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                iterator = iter(function(*args, **kwargs))
+                return self.time_iteration(iterator, time.perf_counter() - start, name, method_labels)
+            return wrapper
+        return decorator
+
+    def time_iteration(self, iterator, elapsed, name, labels):
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(name, elapsed, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        '''
+        This method returns all the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append("# TYPE {name} counter".format(name=name))
+                    typed.add(name)
+                lines.append("{name}{labels} {value}".format(name=name, labels=format_labels(labels), value=value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE {name} histogram".format(name=name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append("{name}_bucket{labels} {value}".format(
+                        name=name, labels=format_labels(labels, [("le", repr(bound))]), value=cumulative))
+                lines.append("{name}_bucket{labels} {value}".format(
+                    name=name, labels=format_labels(labels, [("le", "+Inf")]), value=histogram.count))
+                lines.append("{name}_sum{labels} {value!r}".format(
+                    name=name, labels=format_labels(labels), value=histogram.sum))
+                lines.append("{name}_count{labels} {value}".format(
+                    name=name, labels=format_labels(labels), value=histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, prefix=""):
+        '''
+        This method returns the counters and the count, total, mean and maximum seconds of the histograms
+        whose name starts with prefix.
+        '''
+        summary = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name.startswith(prefix):
+                    summary[name + format_labels(labels)] = value
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name.startswith(prefix):
+                    summary[name + format_labels(labels)] = {
+                        "count": histogram.count, "total": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0, "max": histogram.max}
+        return summary
+
+    def print_summary(self, *prefixes):
+        '''
+        This method prints the summary of the metrics whose name starts with any of the prefixes.
+        '''
+        for prefix in prefixes:
+            for name, value in self.summary(prefix).items():
+                if isinstance(value, dict):
+                    print("{name}: {count} calls, {total:.3f} secs total, {mean:.6f} secs mean, "
+                          "{max:.6f} secs max".format(name=name, **value))
+                else:
+                    print("{name}: {value}".format(name=name, value=value))
+
+
+# Metrics of the process, shared by all the subsystems
+registry = MetricsRegistry()
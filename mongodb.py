@@ -1,23 +1,74 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from dotenv import load_dotenv
+from cache import LRUCache
+from metrics import registry as metrics
 import os
+import time
+
+MISSING = object()  # cached result of a lookup that found nothing
+# Approximate bytes of an index entry and of every posting ({"_id", "title", "url", "t_d_freq"}) in it
+TERM_ENTRY_SIZE = 512
+POSTING_SIZE = 640
+
+
+def term_entry_size(entry):
+    '''
+    This function estimates the memory of a cached index entry from its number of postings, instead of
+    walking the whole posting list.
+    '''
+    return TERM_ENTRY_SIZE + POSTING_SIZE * len(entry["documents"]) if entry is not None else TERM_ENTRY_SIZE
+
+
+class CorpusStats:
+    '''
+    This class holds the statistics of the documents collection used for scoring.
+    '''
+
+    def __init__(self, documents_count, average_length):
+        self.documents_count = documents_count
+        self.average_length = average_length
+
 
 class MongoDB:
     '''
     This class is used for the interoperability of the subsystems of the search engine 
     and the database that contains the documents and the terms that have been crawled.
+    Terms, documents and corpus statistics that are read often are kept in in-process caches,
+    which are emptied by every write to the index or the documents and when another process
+    changes the generation of the index. Cached entries are shared and must not be modified.
     '''
-    def __init__(self):
+    def __init__(self, cache_bytes=256 * 1024 * 1024, generation_check_interval=1.0, max_pool_size=None,
+                 client=None, database=None, host=None):
         load_dotenv()  # load enviromental variables fro
         username = os.getenv("MONGO_INITDB_ROOT_USERNAME")
         password = os.getenv("MONGO_INITDB_ROOT_PASSWORD")
-        self.database = os.getenv("MONGO_INITDB_DATABASE")
-        ip = os.getenv("MONGO_IP")
-        self.client = MongoClient(ip, username=username, password=password, authSource="admin")[self.database]
+        self.database = database if database is not None else os.getenv("MONGO_INITDB_DATABASE")
+        # The server can be given instead of the MONGO_IP environment variable
+        self.host = host if host is not None else os.getenv("MONGO_IP")
+        # Connections shared by the threads of the process, at least one for every serving thread
+        if max_pool_size is None:
+            max_pool_size = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+        # A client can be given instead, e.g. a mongomock client for the benchmarks
+        if client is None:
+            client = MongoClient(self.host, username=username, password=password, authSource="admin",
+                                 maxPoolSize=max_pool_size)
+        self.client = client[self.database]
         self.crawler_db = self.client.crawler_records
         self.documents_db = self.client.documents
         self.indexer_db = self.client.index
+        self.meta_db = self.client.meta
+        # Posting lists and document metadata, bounded by their approximate memory
+        self.term_cache = LRUCache(max_entries=100000, max_bytes=cache_bytes * 3 // 4, sizeof=term_entry_size)
+        self.document_cache = LRUCache(max_entries=100000, max_bytes=cache_bytes // 8)
+        # ID, title and url of the documents of query results
+        self.result_cache = LRUCache(max_entries=100000, max_bytes=cache_bytes // 8)
+        self.corpus_stats = None
+        # Increased by every invalidation, so that results read before it are not cached after it
+        self.cache_epoch = 0
+        self.generation_check_interval = generation_check_interval  # seconds between generation checks
+        self.generation_checked = 0.0
      
+    @metrics.timed("mongodb_call_seconds")
     def reset_crawler(self):
         '''
         This method drops the database tables of the crawler for all the crawled documents
@@ -26,13 +77,98 @@ class MongoDB:
         self.crawler_db.drop()
         self.crawler_db = self.client.crawler_records
 
+    @metrics.timed_iterator("mongodb_call_seconds")
     def find_all_crawler_records(self):
         '''
         This method retrieves and returns all crawled documents.
         '''
         return self.crawler_db.find({}, no_cursor_timeout=True)
 
+    @metrics.timed("mongodb_call_seconds")
+    def find_crawler_record_ids(self):
+        '''
+        This method returns the IDs of all the crawled documents.
+        '''
+        return [item["_id"] for item in self.crawler_db.find({}, {"_id": 1})]
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_crawler_records_by_ids(self, ids, projection=None):
+        '''
+        This method retrieves the crawled documents with the IDs given as parameter.
+        '''
+        return self.crawler_db.find({"_id": {"$in": list(ids)}}, projection)
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_crawler_bags(self):
+        '''
+        This method retrieves the ID, title, url and bag of words of all the crawled documents sorted by ID,
+        without their text and positions.
+        '''
+        return self.crawler_db.find({}, {"title": 1, "url": 1, "bag": 1}, no_cursor_timeout=True).sort("_id", 1)
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_crawler_record_texts(self, ids):
+        '''
+        This method returns the text of the crawled documents with the given IDs like find_document_texts,
+        reading the crawler records instead of the documents database.
+        '''
+        return {record["_id"]: record.get("text", "")
+                for record in self.crawler_db.find({"_id": {"$in": list(ids)}}, {"text": 1})}
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_all_documents(self):
+        '''
+        This method retrieves all the documents of the documents database sorted by their ID,
+        so that the posting lists built from them are also sorted by document ID.
+        '''
+        return self.documents_db.find({}, no_cursor_timeout=True).sort("_id", 1)
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_documents_in_range(self, lower, upper=None):
+        '''
+        This method retrieves the documents with ID from lower (inclusive) to upper (exclusive, or without
+        upper bound if upper is None) sorted by their ID, the shard of a document ID range.
+        '''
+        id_range = {"$gte": lower}
+        if upper is not None:
+            id_range["$lt"] = upper
+        return self.documents_db.find({"_id": id_range}, no_cursor_timeout=True).sort("_id", 1)
+
+    def invalidate_caches(self):
+        '''
+        This method empties the caches after a write to the index or the documents.
+        '''
+        self.cache_epoch += 1
+        self.term_cache.clear()
+        self.document_cache.clear()
+        self.result_cache.clear()
+        self.corpus_stats = None
+
+    def check_generation(self):
+        '''
+        This method empties the caches if the index has been rebuilt by another process since the
+        caches were filled. The generation is read at most every generation_check_interval seconds.
+        '''
+        now = time.monotonic()
+        if now - self.generation_checked < self.generation_check_interval:
+            return
+        self.generation_checked = now
+        generation = self.get_index_generation()
+        if generation != self.term_cache.version:
+            self.cache_epoch += 1
+            self.term_cache.check_version(generation)
+            self.document_cache.check_version(generation)
+            self.result_cache.check_version(generation)
+            self.corpus_stats = None
 
+    def cache_stats(self):
+        '''
+        This method returns the hit rate and size of the term, document and result caches.
+        '''
+        return {"terms": self.term_cache.stats(), "documents": self.document_cache.stats(),
+                "results": self.result_cache.stats()}
+
+    @metrics.timed("mongodb_call_seconds")
     def reset_indexer(self):
         '''
         This method drops the database tables of the indexer and the documents
@@ -42,14 +178,27 @@ class MongoDB:
         self.documents_db.drop()
         self.indexer_db = self.client.index
         self.documents_db = self.client.documents
+        self.invalidate_caches()
 
+    @metrics.timed("mongodb_call_seconds")
     def build_documents_db(self):
         '''
         This method is used as the first step for building the inverted index.
         All the crawled documents are inserted into the documents database.
         '''
         self.documents_db.insert_many(self.find_all_crawler_records())
+        self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
+    def add_documents(self, documents):
+        '''
+        This method inserts new documents in the documents database.
+        '''
+        if documents:
+            self.documents_db.insert_many(documents)
+            self.invalidate_caches()
 
+    @metrics.timed("mongodb_call_seconds")
     def is_initialized(self):
         '''
         This method looks if the documents and index collection of the inverted index are created
@@ -62,19 +211,109 @@ class MongoDB:
         else:
             return False
 
+    @metrics.timed("mongodb_call_seconds")
+    def get_index_generation(self):
+        '''
+        This method returns the generation of the inverted index, a counter increased every time
+        the index is built or updated, so that results computed from an older index can be discarded.
+        '''
+        entry = self.meta_db.find_one({"_id": "index_generation"})
+        return entry["value"] if entry is not None else 0
+
+    @metrics.timed("mongodb_call_seconds")
+    def bump_index_generation(self):
+        '''
+        This method increases the generation of the inverted index.
+        '''
+        self.meta_db.update_one({"_id": "index_generation"}, {"$inc": {"value": 1}}, upsert=True)
+        self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
     def get_documents_count(self):
         '''
         This method returns the number of documents in the database.
         '''
-        return self.documents_db.count()
+        return self.get_corpus_stats().documents_count
 
+    @metrics.timed("mongodb_call_seconds")
+    def get_corpus_stats(self):
+        '''
+        This method returns the number of documents and their average length, computed once
+        until the documents change.
+        '''
+        self.check_generation()
+        corpus_stats = self.corpus_stats
+        if corpus_stats is None:
+            epoch = self.cache_epoch
+            documents_count = self.documents_db.count_documents({})
+            average = list(self.documents_db.aggregate([{"$group": {"_id": None, "length": {"$avg": "$length"}}}]))
+            average_length = average[0]["length"] if average and average[0]["length"] is not None else 0.0
+            corpus_stats = CorpusStats(documents_count, average_length)
+            if epoch == self.cache_epoch:
+                self.corpus_stats = corpus_stats
+        return corpus_stats
+
+    @metrics.timed("mongodb_call_seconds")
     def find_document_by_id(self, d_id):
         '''
         This method searches and returns the document entry with the document ID 
         given as parameter.
         '''
-        return self.documents_db.find_one({"_id": d_id})
+        self.check_generation()
+        document = self.document_cache.get(d_id, MISSING)
+        if document is MISSING:
+            epoch = self.cache_epoch
+            document = self.documents_db.find_one({"_id": d_id})
+            if epoch == self.cache_epoch:
+                self.document_cache.put(d_id, document)
+        return document
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_result_documents(self, ids):
+        '''
+        This method returns the ID, title and url of the documents with the given IDs, e.g. the documents
+        of a page of results, as a dictionary by ID. The documents that are not cached are read with a single
+        query that projects only these fields, so their bags of words are never transferred.
+        '''
+        self.check_generation()
+        documents = {}
+        for d_id in ids:
+            document = self.result_cache.get(d_id)
+            if document is not None:
+                documents[d_id] = document
+        missing = [d_id for d_id in ids if d_id not in documents]
+        if missing:
+            epoch = self.cache_epoch
+            for document in self.documents_db.find({"_id": {"$in": missing}}, {"title": 1, "url": 1}):
+                documents[document["_id"]] = document
+                if epoch == self.cache_epoch:
+                    self.result_cache.put(document["_id"], document)
+        return documents
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_document_texts(self, ids):
+        '''
+        This method returns the stored text of the documents with the given IDs as a dictionary by ID,
+        with a single query. Documents crawled before the text was stored have an empty text.
+        '''
+        return {document["_id"]: document.get("text", "")
+                for document in self.documents_db.find({"_id": {"$in": list(ids)}}, {"text": 1})}
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_documents_by_ids(self, ids, projection=None):
+        '''
+        This method retrieves all the documents with the IDs given as parameter in a single query.
+        '''
+        return self.documents_db.find({"_id": {"$in": list(ids)}}, projection)
 
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_document_table(self):
+        '''
+        This method returns the ID, title, url and length of all the documents sorted by their ID.
+        '''
+        return self.documents_db.find({}, {"title": 1, "url": 1, "length": 1}).sort("_id", 1)
+
+    @metrics.timed("mongodb_call_seconds")
     def find_document_ids(self):
         '''
         This method returns the IDs of all the documents in the documents database. 
@@ -82,21 +321,84 @@ class MongoDB:
         mongo_results = self.documents_db.find({}, {"_id": 1})
         return [item["_id"] for item in mongo_results]
 
+    @metrics.timed("mongodb_call_seconds")
     def add_doc_length(self, doc_id, doc_length):
         '''
         This method adds a new field for every document that contains the 
         length of the document needed for the Query Handler to compute the
         similarity between a document and the query.
         '''
-        self.documents_db.update({"_id": doc_id}, {"$set": {"length": doc_length}})
+        self.documents_db.update_one({"_id": doc_id}, {"$set": {"length": doc_length}})
+        self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
+    def add_doc_norms(self, norms):
+        '''
+        This method sets the length and the maximum term-document frequency of many documents
+        (document ID -> (length, max_t_d_freq)) with a single bulk write.
+        '''
+        requests = [UpdateOne({"_id": doc_id}, {"$set": {"length": length, "max_t_d_freq": max_t_d_freq}})
+                    for doc_id, (length, max_t_d_freq) in norms.items()]
+        if requests:
+            self.documents_db.bulk_write(requests, ordered=False)
+            self.invalidate_caches()
 
+    @metrics.timed("mongodb_call_seconds")
     def add_to_indexer(self, data):
         '''
         This method adds a new term in the inverted index with the term frequency (t_freq) and an array
         of the documents that contain this term 
         '''
         self.indexer_db.insert_one(data)
+        self.invalidate_caches()
 
+    @metrics.timed("mongodb_call_seconds")
+    def add_many_to_indexer(self, entries):
+        '''
+        This method adds a batch of terms in the inverted index with a single round trip.
+        Every entry has the same structure as the ones added by add_to_indexer.
+        '''
+        if entries:
+            self.indexer_db.insert_many(entries, ordered=False)
+            self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
+    def append_to_indexer(self, postings):
+        '''
+        This method appends new postings (term -> list of document postings) to the inverted index
+        with a single bulk write. Terms that do not exist in the index are inserted.
+        '''
+        requests = [UpdateOne({"term": term},
+                              {"$inc": {"t_freq": len(documents)},
+                               "$push": {"documents": {"$each": documents}}},
+                              upsert=True)
+                    for term, documents in postings.items()]
+        if requests:
+            self.indexer_db.bulk_write(requests, ordered=False)
+            self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
+    def add_term_upper_bounds(self, bounds):
+        '''
+        This method sets the maximum inverse document length of the posting list of many terms
+        (term -> value) with a single bulk write. Multiplied by the weight of a term it gives an upper bound
+        of the score the term adds to a document, used by the Query Handler to prune documents.
+        '''
+        requests = [UpdateOne({"term": term}, {"$set": {"max_inv_length": bound}})
+                    for term, bound in bounds.items()]
+        if requests:
+            self.indexer_db.bulk_write(requests, ordered=False)
+            self.invalidate_caches()
+
+    @metrics.timed("mongodb_call_seconds")
+    def create_term_index(self):
+        '''
+        This method creates a database index on the term field of the inverted index, so that
+        looking up a term does not scan the whole collection.
+        '''
+        self.indexer_db.create_index("term")
+
+    @metrics.timed("mongodb_call_seconds")
     def update_indexer(self, term, new_data):
         '''
         Τhis method requires two parameters: the term
@@ -105,12 +407,83 @@ class MongoDB:
         t_freq = entry["t_freq"] + 1
         documents = entry["documents"]
         documents.append(new_data)
-        self.indexer_db.update({"term": term},
-                               {"$set": {"t_freq": t_freq, "documents": documents}})
+        self.indexer_db.update_one({"term": term},
+                                   {"$set": {"t_freq": t_freq, "documents": documents}})
+        self.invalidate_caches()
 
+    @metrics.timed("mongodb_call_seconds")
     def find_term_in_index(self, term):
         '''
         This method looks for a keword in the index table and returns the entry data
         '''
-        return self.indexer_db.find_one({"term": term})
+        self.check_generation()
+        entry = self.term_cache.get(term, MISSING)
+        if entry is MISSING:
+            epoch = self.cache_epoch
+            entry = self.indexer_db.find_one({"term": term})
+            if epoch == self.cache_epoch:
+                self.term_cache.put(term, entry)
+        return entry
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_terms_in_index(self, terms):
+        '''
+        This method returns the index entries of many terms like find_term_in_index, reading all the
+        terms that are not cached with a single query. Terms that are not in the index map to None.
+        '''
+        self.check_generation()
+        entries = {}
+        missing = []
+        for term in terms:
+            entry = self.term_cache.get(term, MISSING)
+            if entry is MISSING:
+                missing.append(term)
+            else:
+                entries[term] = entry
+        if missing:
+            epoch = self.cache_epoch
+            found = {entry["term"]: entry for entry in self.indexer_db.find({"term": {"$in": missing}})}
+            for term in missing:
+                entries[term] = found.get(term)
+                if epoch == self.cache_epoch:
+                    self.term_cache.put(term, entries[term])
+        return entries
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_all_terms(self):
+        '''
+        This method returns all the terms of the inverted index sorted by term, with the document IDs
+        and term-document frequencies of their postings but without the document titles and urls.
+        '''
+        return self.indexer_db.find({}, {"term": 1, "t_freq": 1, "documents._id": 1, "documents.t_d_freq": 1},
+                                    no_cursor_timeout=True).sort("term", 1)
+
+    @metrics.timed_iterator("mongodb_call_seconds")
+    def find_terms_postings(self, terms):
+        '''
+        This method returns the given terms of the inverted index with their term frequency, the maximum
+        inverse length of their documents and the document IDs of their postings, without caching them.
+        '''
+        return self.indexer_db.find({"term": {"$in": list(terms)}},
+                                    {"term": 1, "t_freq": 1, "max_inv_length": 1, "documents._id": 1})
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_term_frequencies(self, terms):
+        '''
+        This method returns the term frequency (number of documents containing the term)
+        of every term given as parameter that exists in the index.
+        '''
+        entries = self.indexer_db.find({"term": {"$in": list(terms)}}, {"term": 1, "t_freq": 1})
+        return {entry["term"]: entry["t_freq"] for entry in entries}
+
+    @metrics.timed("mongodb_call_seconds")
+    def find_documents_containing(self, terms):
+        '''
+        This method returns the IDs of all the documents that contain at least one of the given terms.
+        '''
+        doc_ids = set()
+        entries = self.indexer_db.find({"term": {"$in": list(terms)}}, {"documents._id": 1})
+        for entry in entries:
+            doc_ids.update(document["_id"] for document in entry["documents"])
+        return doc_ids
 
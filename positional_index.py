@@ -0,0 +1,261 @@
+import heapq
+import mmap
+from bisect import bisect_left
+
+import numpy as np
+
+import struct
+
+from binary_index import decode_varints, decode_varints_array, encode_deltas, encode_varints
+from metrics import registry as metrics
+
+POSITIONS_MAGIC = b"SEPI"
+VERSION = 2
+# magic, version, number of documents, number of terms, offset of the term dictionary, fingerprint of the
+# document IDs (see binary_index.documents_fingerprint)
+POSITIONS_HEADER = struct.Struct("<4sIIIQQ")
+# Number of postings of a block, every block has a skip pointer
+SKIP_INTERVAL = 64
+
+
+def encode_positional_postings(postings):
+    '''
+    This function encodes a posting list of (document number, sorted positions) pairs sorted by
+    document number. The postings are split in blocks of SKIP_INTERVAL postings, and every posting is
+    the delta of its document number, the size in bytes of its positions and the deltas of its positions.
+    The skip table that precedes the blocks holds the last document number and the size of every block,
+    so that a reader can jump to the block of a document without decoding the blocks before it.
+    It returns the skip table and the blocks.
+    '''
+    blocks = bytearray()
+    last_doc_nums = []
+    block_sizes = []
+    previous = 0
+    for start in range(0, len(postings), SKIP_INTERVAL):
+        block = bytearray()
+        for doc_num, positions in postings[start:start + SKIP_INTERVAL]:
+            encoded_positions = encode_deltas(positions)
+            block += encode_varints([doc_num - previous, len(encoded_positions)]) + encoded_positions
+            previous = doc_num
+        blocks += block
+        last_doc_nums.append(previous)
+        block_sizes.append(len(block))
+    return encode_deltas(last_doc_nums) + encode_varints(block_sizes), bytes(blocks)
+
+
+def write_positional_index(path, docs_count, fingerprint, terms):
+    '''
+    This function writes a positional index to path.pos. terms yields (term, postings) in term order,
+    where postings is a list of (document number, sorted positions) pairs. The document numbers are
+    the ones of the binary index and of the scoring engine, the positions of the documents sorted by ID,
+    and fingerprint is the fingerprint of the document IDs in this order.
+    '''
+    dictionary = []
+    with open(path + ".pos", "wb") as positions_file:
+        positions_file.write(b"\0" * POSITIONS_HEADER.size)
+        offset = POSITIONS_HEADER.size
+        for term, postings in terms:
+            skips, blocks = encode_positional_postings(sorted(postings))
+            positions_file.write(skips + blocks)
+            dictionary.append((term, len(postings), offset, len(skips)))
+            offset += len(skips) + len(blocks)
+
+        dictionary_offset = offset
+        for term, count, term_offset, skips_size in dictionary:
+            encoded_term = term.encode("utf8")
+            positions_file.write(encode_varints([len(encoded_term)]) + encoded_term +
+                                 encode_varints([count, term_offset, skips_size]))
+        positions_file.seek(0)
+        positions_file.write(POSITIONS_HEADER.pack(POSITIONS_MAGIC, VERSION, docs_count, len(dictionary),
+                                                   dictionary_offset, fingerprint))
+
+
+def within_window(position_lists, window):
+    '''
+    This function checks if one position of every sorted list of positions is within a window of
+    window consecutive positions. The smallest position of the window is advanced with a heap.
+    '''
+    heap = [(positions[0], i, 0) for i, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    last = max(positions[0] for positions in position_lists)
+    while True:
+        first, i, j = heap[0]
+        if last - first < window:
+            return True
+        j += 1
+        if j == len(position_lists[i]):
+            return False
+        last = max(last, position_lists[i][j])
+        heapq.heapreplace(heap, (position_lists[i][j], i, j))
+
+
+class PositionalPostings:
+    '''
+    This class is a cursor over the positional posting list of a term. The cursor is on one document
+    at a time, doc, which is None after the last document. advance uses the skip pointers to jump over
+    the blocks that end before the target document, and the positions of a document are decoded only
+    when they are needed.
+    '''
+
+    def __init__(self, buffer, count, last_doc_nums, block_offsets):
+        self.buffer = buffer
+        self.count = count
+        self.last_doc_nums = last_doc_nums
+        self.block_offsets = block_offsets
+        self.blocks_skipped = 0
+        self.load_block(0)
+
+    def __len__(self):
+        return self.count
+
+    def load_block(self, block):
+        self.block = block
+        self.remaining = min(SKIP_INTERVAL, self.count - block * SKIP_INTERVAL)
+        self.offset = self.block_offsets[block]
+        # The first document number of a block is a delta from the last one of the previous block
+        self.doc = self.last_doc_nums[block - 1] if block > 0 else 0
+        self.next()
+
+    def next(self):
+        '''
+        This method moves the cursor to the next document and returns it.
+        '''
+        if self.remaining == 0:
+            if self.block + 1 == len(self.last_doc_nums):
+                self.doc = None
+                return None
+            self.load_block(self.block + 1)
+            return self.doc
+        (delta, size), offset = decode_varints(self.buffer, self.offset, 2)
+        self.doc += delta
+        self.positions_offset = offset
+        self.positions_size = size
+        self.offset = offset + size
+        self.remaining -= 1
+        return self.doc
+
+    def advance(self, target):
+        '''
+        This method moves the cursor to the first document from target on and returns it, or None
+        if there is no such document.
+        '''
+        if self.doc is None or self.doc >= target:
+            return self.doc
+        if target > self.last_doc_nums[self.block]:
+            block = bisect_left(self.last_doc_nums, target, self.block + 1)
+            if block == len(self.last_doc_nums):
+                self.doc = None
+                return None
+            self.blocks_skipped += block - self.block - 1
+            self.load_block(block)
+        while self.doc is not None and self.doc < target:
+            self.next()
+        return self.doc
+
+    def positions(self):
+        '''
+        This method returns the sorted positions of the term in the current document as a NumPy array.
+        '''
+        return np.cumsum(decode_varints_array(self.buffer, self.positions_offset, self.positions_size))
+
+
+class PositionalIndex:
+    '''
+    This class serves a positional index written by write_positional_index from a memory mapped file.
+    It finds the documents that contain a phrase or all the terms of a proximity query: the posting lists
+    are intersected starting from the rarest term, jumping over the blocks of the other terms with their
+    skip pointers, and the positions are compared only for the documents that contain all the terms.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.positions_file = open(path + ".pos", "rb")
+        self.positions = mmap.mmap(self.positions_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.docs_count, num_terms, dictionary_offset, self.fingerprint = \
+            POSITIONS_HEADER.unpack_from(self.positions, 0)
+        if magic != POSITIONS_MAGIC or version != VERSION:
+            raise ValueError("{path}.pos is not a positional index file".format(path=path))
+
+        # term -> (number of postings, offset, size of the skip table)
+        self.dictionary = {}
+        offset = dictionary_offset
+        for _ in range(num_terms):
+            (term_size, ), offset = decode_varints(self.positions, offset, 1)
+            term = self.positions[offset:offset + term_size].decode("utf8")
+            offset += term_size
+            entry, offset = decode_varints(self.positions, offset, 3)
+            self.dictionary[term] = tuple(entry)
+
+    def close(self):
+        self.positions.close()
+        self.positions_file.close()
+
+    def get_documents_count(self):
+        return self.docs_count
+
+    def find_postings(self, term):
+        '''
+        This method returns a PositionalPostings cursor on the first document of a term, or None if
+        the term is not in the index.
+        '''
+        entry = self.dictionary.get(term)
+        if entry is None:
+            return None
+        count, offset, skips_size = entry
+        num_blocks = (count + SKIP_INTERVAL - 1) // SKIP_INTERVAL
+        skips = decode_varints_array(self.positions, offset, skips_size)
+        last_doc_nums = np.cumsum(skips[:num_blocks]).tolist()
+        block_offsets = (offset + skips_size + np.cumsum(skips[num_blocks:]) - skips[num_blocks:]).tolist()
+        return PositionalPostings(self.positions, count, last_doc_nums, block_offsets)
+
+    def find_phrase(self, terms, window=None):
+        '''
+        This method returns the sorted NumPy array of the numbers of the documents that contain the terms
+        as a phrase, consecutive and in order, or if window is given that contain all the terms, in any
+        order, within window consecutive positions.
+        '''
+        cursors = {}
+        for term in terms:
+            if term not in cursors:
+                cursors[term] = self.find_postings(term)
+                if cursors[term] is None:
+                    return np.zeros(0, dtype=np.int64)
+        # The rarest term gives the candidates, the other terms are advanced to them
+        rarest, *others = sorted(cursors.values(), key=len)
+        matches = []
+        candidates = 0
+        doc = rarest.doc
+        while doc is not None:
+            candidates += 1
+            found = doc
+            for cursor in others:
+                found = cursor.advance(doc)
+                if found != doc:
+                    break
+            if found is None:
+                break
+            if found != doc:
+                # Jump the rarest term to the next document that the other term contains
+                doc = rarest.advance(found)
+                continue
+            if self.positions_match(terms, cursors, window):
+                matches.append(doc)
+            doc = rarest.next()
+
+        metrics.inc("positional_candidates_total", candidates)
+        metrics.inc("positional_blocks_skipped_total", sum(cursor.blocks_skipped for cursor in cursors.values()))
+        return np.array(matches, dtype=np.int64)
+
+    def positions_match(self, terms, cursors, window):
+        '''
+        This method checks the positions of the terms in the document all the cursors are on.
+        '''
+        if window is None:
+            # Positions where the phrase starts, shifted by the place of every term in the phrase
+            starts = cursors[terms[0]].positions()
+            for i, term in enumerate(terms[1:], 1):
+                starts = np.intersect1d(starts, cursors[term].positions() - i, assume_unique=True)
+                if len(starts) == 0:
+                    return False
+            return True
+        return within_window([cursor.positions().tolist() for cursor in cursors.values()], window)
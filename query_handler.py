@@ -1,213 +1,531 @@
-from mongodb import MongoDB
+from analyzer import analyze_words, make_snippet
+from binary_index import BinaryIndex
+from executor import BoundedExecutor
+from metrics import registry as metrics
+from cache import LRUCache
+from mongodb import MISSING, MongoDB
+from positional_index import PositionalIndex
+from segments import SegmentIndex
+from snapshot import SnapshotStore
+from scoring import ScoringEngine, intersect_postings, term_weight
+from collections import Counter
+import math
+import os
+import re
 import threading
 import time
-import math
+import numpy as np
+
+# A phrase in double quotes, optionally followed by ~ and the window of a proximity query
+PHRASE_REGEX = re.compile(r'"([^"]*)"(?:~(\d+))?')
+# Boolean operators of a query, written in capitals to tell them from keywords
+OPERATORS = ("AND", "OR")
 
 
 class QueryHandler:
-    def __init__(self, num_threads_array=5):
-        self.thread_array = []
+    '''
+    This class executes queries against the inverted index. It is re-entrant: the database connection,
+    the binary index and the scoring engine are shared read-only state, and all the state of a query is
+    local to the call, so one QueryHandler can serve concurrent requests from many threads.
+    '''
+    def __init__(self, num_threads_array=5, index_path=None, pruning=False, max_expansion=50, db=None,
+                 segment_path=None, positional_path=None, default_operator="OR", snapshot_path=None,
+                 generation_check_interval=1.0, postings_cache_bytes=128 * 1024 * 1024):
         self.num_threads = num_threads_array
-        self.db = MongoDB()
-        self.num_docs = 0
-        self.scores = {}
-        self.query = {}
-        self.locker = threading.Lock()
-        self.relevantLocker = threading.Lock()
-        self.nonRelevantLocker = threading.Lock()
+        self.db = db if db is not None else MongoDB()
+        # Runs the independent database reads of a request concurrently
+        self.executor = BoundedExecutor(num_threads_array, name="query")
+        # Serve queries from an exported binary index instead of the database if one is given
+        self.binary_index = BinaryIndex(index_path) if index_path is not None else None
+        # Or from a segment index that changes while it is served
+        self.segments = SegmentIndex(segment_path) if segment_path is not None else None
+        # Or from the current version of the snapshots published by the indexer. Queries are answered from the
+        # snapshot, but snippets and relevance feedback still read the database, whose client connects lazily
+        self.snapshots = SnapshotStore(snapshot_path) if snapshot_path is not None else None
+        # Positional index for phrase and proximity queries, exported next to the binary index by default
+        if positional_path is None and index_path is not None and os.path.exists(index_path + ".pos"):
+            positional_path = index_path
+        self.positional_index = PositionalIndex(positional_path) if positional_path is not None else None
+        self.engine = None
+        self.engineLocker = threading.Lock()
+        # Posting lists of the database converted to document numbers of the engine, by (generation, term)
+        self.postings_cache = LRUCache(max_entries=100000, max_bytes=postings_cache_bytes)
+        # Use MaxScore dynamic pruning to find the top k documents instead of scoring all of them. It visits
+        # the candidates one by one in Python, so it is slower than scoring whole posting lists with NumPy
+        # unless the posting lists are very long and the pruning skips most of them
+        self.pruning = pruning
+        # Maximum number of terms of a weighted query vector, e.g. a Rocchio expanded query
+        self.max_expansion = max_expansion
+        # Operator of consecutive keywords without an operator between them, "OR" or "AND"
+        if default_operator not in OPERATORS:
+            raise ValueError("default_operator must be AND or OR")
+        self.default_operator = default_operator
+        # The generation of the database index is read at most every generation_check_interval seconds
+        self.generation_check_interval = generation_check_interval
+        self.generation = None
+        self.generation_checked = 0.0
 
-    def main(self, query, k):
+    def main(self, query, k, snippets=False):
         '''
         This method calculates the query results calculating the score of documents using cosine similarity formula.
+        The query is either a list of keywords or a weighted query vector (term -> weight), such as the
+        one returned by rocchio_relevance_feedback, in which the score of every term is multiplied by its weight.
+        Keywords in double quotes are a phrase, and only the documents that contain every phrase are returned
+        (see parse_phrases). Keywords can be combined with the AND and OR operators (see parse_boolean).
+        If snippets is True every result also has a snippet of its text with the query terms highlighted.
+        '''
+        query_results, _ = self.search(query, k, snippets)
+        return query_results
+
+    def search(self, query, k, snippets=False):
+        '''
+        This method returns the results of a query like main, together with the PruningStats of the
+        query, or None if pruning is disabled.
         '''
         print("We are processing your query...")
-        top_k = k
-        self.scores = {} #document scores
-        
-        
-        self.scores.clear()
-        self.num_docs = self.db.get_documents_count() #number of documents in database
-
-        query_keywords = [keyword.lower() for keyword in query] #query keywords to lowercase
-        self.query_kewords = query_keywords
-        #loop for every term in query
-        for term in query_keywords:
-            word = self.db.find_term_in_index(term)
-            if word is not None:
-                t_freq = word["t_freq"]
-
-                for document in word["documents"]:
-                    
-                    while sum([1 for t in self.thread_array if t.is_alive()]) > 1:
-                        time.sleep(0.5)
-
-                    new_task = threading.Thread(
-                        target=self.score, args=(document, t_freq, ))
-                    new_task.start()
-                    self.thread_array.append(new_task)
-        #Wait all threads to finish
-        while sum([1 for t in self.thread_array if t.is_alive()]) > 0:
-            time.sleep(0.5)
-
-        # Normalize the document scores using the document length
-        for doc_id in self.scores.keys():
-            retrieved_doc = self.db.find_document_by_id(doc_id)
-            if retrieved_doc is not None:
-                doc_length = retrieved_doc["length"]
-                self.scores[doc_id] = self.scores[doc_id] / doc_length
-
-        # Sort scores in descending order
-        scores = {k: v for k, v in sorted(
-            self.scores.items(), key=lambda x: x[1], reverse=True)}
+        start = time.perf_counter()
+        # The engine of this query is used until it finishes, even if a newer one is loaded meanwhile
+        with metrics.timer("query_phase_seconds", phase="engine"):
+            engine = self.load_scoring_engine()
+            num_docs = self.get_documents_count(engine) #number of documents in database
+
+        with metrics.timer("query_phase_seconds", phase="normalization"):
+            query_vector = self.query_vector(query)
+            query_filter = self.query_filter(query)
+        with metrics.timer("query_phase_seconds", phase="term_fetch"):
+            postings = self.find_postings_of_terms(query_vector, engine)
+        with metrics.timer("query_phase_seconds", phase="scoring"):
+            top_k, pruning_stats = self.rank(query_vector, postings, k, engine, num_docs, query_filter)
 
         # Get documents with the k best scores
-        query_results = []
-        k = 0
-        for doc_id in scores.keys():
-            k += 1
-            document = self.db.find_document_by_id(doc_id)
-            query_results.append(
-                {"_id": document["_id"], "title": document["title"], "url": document["url"]})
-            if k == top_k:
-                break
+        with metrics.timer("query_phase_seconds", phase="hydration"):
+            query_results = self.find_documents(top_k, engine, query_vector if snippets else None)
+        metrics.observe("query_seconds", time.perf_counter() - start)
         print("Query Handler finished!")
 
-        return query_results
+        return query_results, pruning_stats
 
-    def score(self, document, term_freq):
+    def search_batch(self, queries):
         '''
-        This method calculates the score of a document for a given term frequency using TF-IDF 
-        formula and cosine similarity.
+        This method returns the results of many (query, k) pairs, in the order of the queries.
+        The posting lists of the terms of all the queries are read once, and the documents of all
+        the results are fetched together, so queries that share terms share their lookups.
         '''
-        id = document["_id"]
-        if id not in self.scores.keys():
-           
-            with self.locker:
-                self.scores[id] = 0
-        tf = 1+math.log(term_freq)
-        idf = math.log(1+(self.num_docs/term_freq))
-        with self.locker:
-            self.scores[id] = self.scores[id] + tf * idf
+        print("We are processing {count} queries...".format(count=len(queries)))
+        start = time.perf_counter()
+        with metrics.timer("query_batch_phase_seconds", phase="engine"):
+            engine = self.load_scoring_engine()
+            num_docs = self.get_documents_count(engine)
+
+        with metrics.timer("query_batch_phase_seconds", phase="normalization"):
+            query_vectors = [self.query_vector(query) for query, _ in queries]
+            terms = set()
+            for query_vector in query_vectors:
+                terms.update(query_vector)
+        with metrics.timer("query_batch_phase_seconds", phase="term_fetch"):
+            postings = self.find_postings_of_terms(terms, engine)
+        with metrics.timer("query_batch_phase_seconds", phase="scoring"):
+            rankings = [self.rank(query_vector, postings, k, engine, num_docs, self.query_filter(query))[0]
+                        for query_vector, (query, k) in zip(query_vectors, queries)]
+
+        with metrics.timer("query_batch_phase_seconds", phase="hydration"):
+            documents = iter(self.find_documents([doc_num for top_k in rankings for doc_num in top_k], engine))
+            batch_results = [[next(documents) for _ in top_k] for top_k in rankings]
+        metrics.observe("query_batch_seconds", time.perf_counter() - start)
+        metrics.inc("query_batch_queries_total", len(queries))
+        print("Query Handler finished!")
 
-    def computeRelevantTF(self, doc):
+        return batch_results
+
+    def rank_documents(self, query, k):
         '''
-        This method calculates the term summation of term frequencies in a document for 
-        all documents declared as relevant
+        This method returns the scoring engine and the numbers of the documents with the k best scores
+        for a query, without fetching the documents, so that the ranking can be kept and its documents
+        fetched page by page with find_documents.
         '''
-        for new_term in doc["bag"]:
-            term = self.db.find_term_in_index(new_term)
-            with self.relevantLocker:
-                if new_term in self.relevantDocsTF:
-                    self.relevantDocsTF[new_term] = self.relevantDocsTF[new_term] + \
-                        term["t_freq"]
-                else:
-                    self.relevantDocsTF[new_term] = term["t_freq"]
+        engine = self.load_scoring_engine()
+        query_vector = self.query_vector(query)
+        postings = self.find_postings_of_terms(query_vector, engine)
+        top_k, _ = self.rank(query_vector, postings, k, engine, self.get_documents_count(engine),
+                             self.query_filter(query))
+        return engine, top_k
 
-    def computeNonRelevantTf(self, doc):
+    def rank(self, query_vector, postings, k, engine, num_docs, query_filter=None):
         '''
-        This method calculates the term summation of term frequencies in a document for 
-        all documents declared as not relevant
+        This method returns the numbers of the documents with the k best scores for a query vector,
+        given the posting lists of its terms, and the PruningStats of the ranking or None. If the
+        query_filter of the query is given only the documents that match it are scored.
         '''
-        for new_term in doc["bag"]:
-            term = self.db.find_term_in_index(new_term)
-            with self.nonRelevantLocker:
-                if new_term in self.nonrelevantDocsTF:
-                    self.nonrelevantDocsTF[new_term] = self.nonrelevantDocsTF[new_term] + \
-                        term["t_freq"]
-                else:
-                    self.nonrelevantDocsTF[new_term] = term["t_freq"]
+        matches = self.match_filter(query_filter, postings, engine) if query_filter is not None else None
+        # Weight the score of the posting list of every term in query with the weight of the term
+        weighted_postings = []
+        for term, query_weight in query_vector.items():
+            word = postings.get(term)
+            if word is not None:
+                t_freq, doc_nums, max_inverse_length = word
+                if matches is not None:
+                    doc_nums = intersect_postings([doc_nums, matches])
+                weighted_postings.append((query_weight * term_weight(t_freq, num_docs), doc_nums, max_inverse_length))
 
-    def rocchio_relevance_feedback(self, relevantDocs, nonrelevantDocs):
+        if self.pruning:
+            top_k, pruning_stats = engine.top_k_maxscore(weighted_postings, k)
+            metrics.inc("query_postings_scored_total", pruning_stats.postings_scored)
+            metrics.inc("query_postings_skipped_total", pruning_stats.postings_skipped)
+            return top_k, pruning_stats
+        # Score all the documents and normalize the scores using the document length
+        doc_nums, scores = engine.score([(weight, doc_nums) for weight, doc_nums, _ in weighted_postings])
+        return engine.top_k(doc_nums, scores, k), None
+
+    def normalize_query(self, query):
         '''
-        This method returns a new query vector calculated using Rocchio formula 
+        This method returns the terms that are looked up in the index for the keywords of a query.
+        The keywords are analyzed like the words of the crawled pages, so stop words are removed and
+        e.g. "Running" is looked up as the term "run".
+        '''
+        return analyze_words(query)
+
+    def query_vector(self, query):
+        '''
+        This method returns the weights of the index terms of a query. A term repeated in a list of keywords
+        gets a weight equal to its number of occurrences. The keys of a weighted query vector are index terms,
+        e.g. the terms of a Rocchio expanded query, and are only converted to lowercase. Of a weighted query
+        vector only the max_expansion terms with the largest positive weights are kept, which bounds the
+        posting lists read for an expanded query.
+        '''
+        if not isinstance(query, dict):
+            keywords = [keyword for keyword in self.parse_phrases(query)[0] if keyword not in OPERATORS]
+            return dict(Counter(self.normalize_query(keywords)))
+        query_vector = Counter()
+        for term, weight in query.items():
+            query_vector[term.lower()] += weight
+        weights = sorted(((term, weight) for term, weight in query_vector.items() if weight > 0),
+                         key=lambda x: x[1], reverse=True)
+        return dict(weights[:self.max_expansion])
+
+    def parse_phrases(self, keywords):
+        '''
+        This method splits a list of keywords into the plain keywords and the phrases of a query.
+        A phrase is a sequence of keywords in double quotes, e.g. "new york", and a proximity query
+        is a phrase followed by a window, e.g. "pizza york"~10, which matches the documents that contain
+        all its keywords in any order within that many consecutive words. It returns all the keywords,
+        including the keywords of the phrases, and the (terms, window) of every phrase, where the window
+        of an exact phrase is None.
+        '''
+        text = " ".join(keywords)
+        phrases = []
+        for match in PHRASE_REGEX.finditer(text):
+            terms = self.normalize_query(match.group(1).split())
+            if terms:
+                phrases.append((terms, int(match.group(2)) if match.group(2) else None))
+        keywords = PHRASE_REGEX.sub(lambda match: " " + match.group(1) + " ", text).replace('"', " ").split()
+        return keywords, phrases
+
+    def parse_boolean(self, keywords):
+        '''
+        This method returns the conjunctive clauses of a list of keywords with boolean operators, as lists
+        of terms. A document matches the query if it contains all the terms of any clause. AND binds tighter
+        than OR, so "apple AND pie OR cake" matches the documents with both apple and pie or with cake, and
+        consecutive keywords without an operator are joined by the default operator. It returns None for a
+        disjunction of single terms, which every document that contains any keyword matches.
+        '''
+        clauses = [[]]
+        operator = None
+        for keyword in keywords:
+            if keyword in OPERATORS:
+                operator = keyword
+                continue
+            terms = self.normalize_query([keyword])
+            if not terms:
+                continue
+            if clauses[-1] and (operator or self.default_operator) == "OR":
+                clauses.append([])
+            clauses[-1].extend(terms)
+            operator = None
+        clauses = [clause for clause in clauses if clause]
+        if all(len(clause) == 1 for clause in clauses):
+            return None
+        return clauses
+
+    def query_filter(self, query):
+        '''
+        This method returns the phrases and the boolean clauses of a list of keywords, or None if every
+        document that contains any keyword matches the query, which is always the case for a query vector.
+        '''
+        if isinstance(query, dict):
+            return None
+        keywords, phrases = self.parse_phrases(query)
+        clauses = self.parse_boolean(keywords)
+        if not phrases and clauses is None:
+            return None
+        return phrases, clauses
+
+    def match_filter(self, query_filter, postings, engine):
+        '''
+        This method returns the sorted document numbers of the documents that match the query_filter of
+        a query, given the posting lists of its terms, or None if the filter cannot be applied. The
+        posting lists of every clause are intersected starting from the shortest one.
+        '''
+        phrases, clauses = query_filter
+        matches = None
+        if clauses is not None:
+            matches = np.zeros(0, dtype=np.int64)
+            for clause in clauses:
+                if all(term in postings for term in clause):
+                    clause_matches = intersect_postings([postings[term][1] for term in clause])
+                    matches = np.union1d(matches, clause_matches)
+        if phrases:
+            phrase_matches = self.match_phrases(phrases, engine)
+            if phrase_matches is not None:
+                matches = phrase_matches if matches is None else intersect_postings([matches, phrase_matches])
+        return matches
 
+    def match_phrases(self, phrases, engine):
         '''
+        This method returns the sorted document numbers of the documents that contain all the phrases,
+        or None if there is no positional index of the documents of the engine, in which case the
+        keywords of the phrases are searched as plain keywords.
+        '''
+        if self.segments is not None:
+            # A positional index numbers the documents by ID, while the segments number them in flush order
+            positional_index = None
+        elif self.snapshots is not None:
+            positional_index = engine.index.positional_index  # every snapshot has its own positional index
+        else:
+            positional_index = self.positional_index
+        # The positional index must number the same documents as the engine, e.g. not a file exported
+        # before the last rebuild
+        if positional_index is not None:
+            fingerprint = engine.index.fingerprint if engine.index is not None else engine.fingerprint
+            if positional_index.fingerprint != fingerprint:
+                positional_index = None
+        if positional_index is None:
+            print("There is no positional index of the documents, phrases are searched as keywords")
+            return None
+        matches = None
+        for terms, window in phrases:
+            doc_nums = positional_index.find_phrase(terms, window)
+            matches = doc_nums if matches is None else intersect_postings([matches, doc_nums])
+        return matches
+
+    def get_documents_count(self, engine):
+        if engine.index is not None:
+            return engine.index.get_documents_count()
+        return self.db.get_documents_count()
+
+    def get_index_generation(self):
+        '''
+        This method returns the generation of the served index, which changes whenever its results can change.
+        '''
+        snapshot = self.current_snapshot()
+        if snapshot is not None:
+            return snapshot.generation
+        if self.binary_index is not None:
+            return 0  # an exported binary index never changes while it is served
+        now = time.monotonic()
+        if self.generation is None or now - self.generation_checked >= self.generation_check_interval:
+            self.generation = self.db.get_index_generation()
+            self.generation_checked = now
+        return self.generation
+
+    def is_initialized(self):
+        if self.segments is not None:
+            return self.segments.exists()
+        if self.snapshots is not None:
+            return self.snapshots.exists()
+        if self.binary_index is not None:
+            return True
+        return self.db.is_initialized()
+
+    def current_snapshot(self):
+        '''
+        This method returns the current snapshot of the segment index or of the snapshot store that is
+        served, or None if the served index does not change while it is served.
+        '''
+        if self.segments is not None:
+            return self.segments.snapshot()
+        if self.snapshots is not None:
+            return self.snapshots.snapshot()
+        return None
 
-        weights = {}
-        for term in self.db.indexer_db.find({}):
+    def warm_up(self):
+        '''
+        This method loads the scoring engine before the first query, so that a new server answers its
+        first queries as fast as the next ones.
+        '''
+        start = time.perf_counter()
+        engine = self.load_scoring_engine()
+        print("Query Handler loaded {count} documents in {seconds:.3f} secs".format(
+            count=len(engine), seconds=time.perf_counter() - start))
+
+    def load_scoring_engine(self):
+        '''
+        This method returns the scoring engine with the lengths of all documents preloaded.
+        The engine is loaded again when a new generation of the database index, of the segment index or
+        of the snapshot store is visible, since a rebuild can change the documents without changing
+        their number.
+        '''
+        engine = self.engine
+        snapshot = self.current_snapshot()
+        generation = self.get_index_generation() if snapshot is None and self.binary_index is None else None
+        if engine is not None:
+            if snapshot is not None:
+                current = engine.index is snapshot
+            else:
+                current = self.binary_index is not None or engine.generation == generation
+            if current:
+                return engine
+        with self.engineLocker:
+            # Another request may have loaded the engine while this one was waiting
+            if self.engine is not engine:
+                return self.engine
+            index = snapshot if snapshot is not None else self.binary_index
+            if index is not None:
+                engine = ScoringEngine(index.doc_lengths(), index=index)
+            else:
+                # The generation is read before the documents, so a rebuild meanwhile loads them again
+                documents = list(self.db.find_document_table())
+                engine = ScoringEngine([document.get("length", 0.0) for document in documents],
+                                       [document["_id"] for document in documents], generation=generation)
+                # The posting lists of the previous engine number its documents
+                self.postings_cache.check_version(generation)
+            self.engine = engine
+        return engine
+
+    def find_postings(self, term, engine):
+        '''
+        This method returns the term frequency of a term, the sorted document numbers of its posting list
+        and the maximum inverse length of these documents, or None if the term is not in the index.
+        '''
+        return self.find_postings_of_terms([term], engine).get(term)
 
-            # initialize weight vector for each key in inverted file
-            weights[term["term"]] = 0.0
+    def find_postings_of_terms(self, terms, engine):
+        '''
+        This method returns the postings of many terms like find_postings, as a dictionary of the terms
+        that are in the index. The database is queried once for all the terms that are not cached, and
+        their posting lists are cached as arrays of the document numbers of the engine.
+        '''
+        postings = {}
+        if engine.index is not None:
+            for term in terms:
+                word = engine.index.find_term_arrays(term)
+                if word is not None:
+                    t_freq, doc_nums, _, max_inverse_length = word
+                    postings[term] = (t_freq, doc_nums, max_inverse_length)
+            return postings
+        missing = []
+        for term in terms:
+            word = self.postings_cache.get((engine.generation, term), MISSING)
+            if word is MISSING:
+                missing.append(term)
+            elif word is not None:
+                postings[term] = word
+        if not missing:
+            return postings
+        entries = {entry["term"]: entry for entry in self.db.find_terms_postings(missing)}
+        for term in missing:
+            entry = entries.get(term)
+            word = None
+            size = 64
+            if entry is not None:
+                doc_nums = np.sort(engine.to_doc_nums(document["_id"] for document in entry["documents"]))
+                # Indexes built before the upper bounds were stored get them from the preloaded lengths
+                max_inverse_length = entry.get("max_inv_length")
+                if max_inverse_length is None:
+                    max_inverse_length = engine.max_inverse_length(doc_nums)
+                word = postings[term] = (entry["t_freq"], doc_nums, max_inverse_length)
+                size += doc_nums.nbytes
+            self.postings_cache.put((engine.generation, term), word, size=size)
+        return postings
+
+    def find_documents(self, doc_nums, engine, terms=None):
+        '''
+        This method returns the ID, title and url of a list of document numbers of a scoring engine.
+        The documents of a binary or segment index are read from its document table, and the documents
+        of the database that are not cached are read with a single projected query. If the query terms
+        are given, the texts of all the documents are read with one more query and every result also
+        has a snippet of its text with the terms highlighted. The texts of a segment index are read from
+        the crawler records, which are saved before the pages are flushed to a segment and, unlike the
+        documents database, are not rebuilt by a reindex.
+        '''
+        if engine.index is not None:
+            query_results = [engine.index.find_document(doc_num) for doc_num in doc_nums]
+        else:
+            documents = self.db.find_result_documents([engine.doc_ids[doc_num] for doc_num in doc_nums])
+            query_results = [{"_id": document["_id"], "title": document["title"], "url": document["url"]}
+                             for document in (documents[engine.doc_ids[doc_num]] for doc_num in doc_nums)]
+        if terms is not None:
+            ids = [result["_id"] for result in query_results]
+            if self.segments is not None:
+                texts = self.db.find_crawler_record_texts(ids)
+            else:
+                texts = self.db.find_document_texts(ids)
+            for result in query_results:
+                result["snippet"] = make_snippet(texts.get(result["_id"], ""), terms)
+        return query_results
+
+    def count_document_terms(self, ids):
+        '''
+        This method returns the number of the given documents that contain every term. The bags of words
+        of a segment index are read from the crawler records, like the texts of its snippets.
+        '''
+        counts = Counter()
+        if self.segments is not None:
+            documents = self.db.find_crawler_records_by_ids(ids, {"bag": 1})
+        else:
+            documents = self.db.find_documents_by_ids(ids, {"bag": 1})
+        for doc in documents:
+            counts.update(doc["bag"].keys())
+        return counts
+
+    @metrics.timed("query_feedback_seconds")
+    def rocchio_relevance_feedback(self, relevantDocs, nonrelevantDocs, query):
+        '''
+        This method returns a new query vector calculated using Rocchio formula 
+        for the given query keywords.
+        The vector is sparse: only the query terms and the terms of the judged documents can get
+        a weight, so the cost depends on the judged documents and not on the size of the vocabulary.
+        '''
+        query_keywords = set(self.query_vector(query))
         alpha = 0.5
         beta = 0.7
         gamma = 0.1
-        for term in self.query_kewords:
-            self.query[term] = 1.0
 
-        self.relevantDocsTF = {}
-        self.nonrelevantDocsTF = {}
+        # Number of relevant and non relevant documents that contain every term, read concurrently
+        relevant = self.executor.submit(self.count_document_terms, relevantDocs)
+        nonrelevant_counts = self.count_document_terms(nonrelevantDocs)
+        relevant_counts = relevant.result()
+
+        terms = set(query_keywords) | set(relevant_counts) | set(nonrelevant_counts)
+        engine = self.load_scoring_engine()
+        if engine.index is not None:
+            # The statistics of the served index, since the database index may be rebuilt meanwhile
+            term_frequencies = {term: engine.index.term_frequency(term) for term in terms}
+            num_docs = engine.index.get_documents_count()
+        else:
+            term_frequencies = self.db.find_term_frequencies(terms)
+            num_docs = self.db.get_documents_count()
 
-        # ------------------------------------- #
-        # Compute relevantDocsTF and nonrelevantDocsTF vectors
-        for docId in relevantDocs:
-            doc = self.db.find_document_by_id(docId)
-
-            # Wait until thread pool has an available thread
-            while sum([1 for t in self.thread_array if t.is_alive()]) > self.num_threads:
-                time.sleep(0.5)
-
-            new_task = threading.Thread(
-                target=self.computeRelevantTF, args=(doc, ))
-            new_task.start()
-            self.thread_array.append(new_task)
-            '''
-            for new_term in doc["bag"]:
-                term=self.db.find_term_in_index(new_term)
-                
-
-                if new_term in relevantDocsTF:
-                    relevantDocsTF[new_term] = relevantDocsTF[new_term] + term["t_freq"]
-                else:
-                    relevantDocsTF[new_term] = term["t_freq"]
-'''
-
-        for docId in nonrelevantDocs:
-            doc = self.db.find_document_by_id(docId)
-            # Wait until thread pool has an available thread
-            while sum([1 for t in self.thread_array if t.is_alive()]) > self.num_threads:
-                time.sleep(0.5)
-
-            new_task = threading.Thread(
-                target=self.computeNonRelevantTf, args=(doc, ))
-            new_task.start()
-            self.thread_array.append(new_task)
-            '''
-            for new_term in doc["bag"]:
-                term=self.db.find_term_in_index(new_term)
-                             
-
-                if new_term in nonrelevantDocsTF:
-                    nonrelevantDocsTF[new_term] = nonrelevantDocsTF[new_term] + term["t_freq"]
-                else:
-                    nonrelevantDocsTF[new_term] = term["t_freq"]
-
-'''
         # ------------------------------------- #
         # Compute Rocchio vector
-        for term in self.db.indexer_db.find({}):
-            new_term = self.db.find_term_in_index(term["term"])
-            idf = math.log(float(self.db.get_documents_count()) /
-                           float(len(new_term["documents"])), 10)
-            new_term = new_term["term"]
-
-            # Terms 2 and 3 of Rocchio algorithm
-
-            if new_term in self.relevantDocsTF:
-                # Term 2: Relevant documents weights normalized and given BETA weight
-                weights[new_term] = weights[new_term] + beta * idf * \
-                    (self.relevantDocsTF[new_term] / len(relevantDocs))
-            if new_term in self.nonrelevantDocsTF:
-                # Term 3: NonRelevant documents weights normalized and given BETA weight
-                weights[new_term] = weights[new_term] - gamma * idf * \
-                    (self.nonrelevantDocsTF[new_term]/len(nonrelevantDocs))
+        new_query = {}
+        for term in terms:
+            weight = 0.0
+            t_freq = term_frequencies.get(term)
+            if t_freq:
+                idf = math.log(float(num_docs) / float(t_freq), 10)
+                # Every judged document adds the term frequency of the terms it contains
+                if term in relevant_counts:
+                    # Term 2: Relevant documents weights normalized and given BETA weight
+                    weight += beta * idf * (t_freq * relevant_counts[term] / len(relevantDocs))
+                if term in nonrelevant_counts:
+                    # Term 3: NonRelevant documents weights normalized and given GAMMA weight
+                    weight -= gamma * idf * (t_freq * nonrelevant_counts[term] / len(nonrelevantDocs))
             # Term 1 of Rocchio, query terms
+            if term in query_keywords:
+                new_query[term] = alpha * 1.0 + weight  # build new query vector of weights
+            elif weight > 0:
+                new_query[term] = weight
+        new_query = {k: v for k, v in sorted(
+            new_query.items(), key=lambda x: x[1], reverse=True)}
 
-            if term in self.query_kewords:
-                self.query[new_term] = alpha * self.query[new_term] + \
-                    weights[new_term]  # build new query vector of weights
-            elif weights[new_term] > 0:
-                self.query[new_term] = weights[new_term]
-        self.query = {k: v for k, v in sorted(
-            self.query.items(), key=lambda x: x[1], reverse=True)}
-
-        return self.query
+        return new_query
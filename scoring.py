@@ -0,0 +1,218 @@
+import heapq
+import math
+from bisect import bisect_left
+from itertools import accumulate
+
+import numpy as np
+
+from binary_index import documents_fingerprint
+
+
+def term_weight(term_freq, num_docs):
+    '''
+    This function calculates the TF-IDF weight that a term with the given term frequency
+    adds to the score of every document that contains it.
+    '''
+    tf = 1 + math.log(term_freq)
+    idf = math.log(1 + (num_docs / term_freq))
+    return tf * idf
+
+
+def squared_weight(term_freq, docs_count):
+    '''
+    This function calculates the squared weight that a term with the given term frequency
+    adds to the length of every document that contains it.
+    '''
+    if docs_count < 2:
+        return 0.0
+    nidf = math.log(docs_count / term_freq) / math.log(docs_count)
+    return math.pow(nidf * nidf, 2)
+
+
+def document_length(bag, term_frequencies, docs_count):
+    '''
+    This function calculates the length of a document from the term frequencies of the words
+    in its bag and the total number of documents.
+    '''
+    return math.sqrt(sum(squared_weight(term_frequencies[word], docs_count) for word in bag))
+
+
+def intersect_postings(postings):
+    '''
+    This function returns the sorted document numbers that are in all the sorted document number arrays
+    of postings. The documents of the shortest array are the candidates, and they are searched in the other
+    arrays in ascending length order with a binary search, which jumps over the ranges of documents between
+    two candidates. The cost depends on the length of the shortest array and only logarithmically on the
+    length of the others, so the posting list of a common term is never scanned.
+    '''
+    postings = sorted(postings, key=len)
+    candidates = postings[0]
+    for doc_nums in postings[1:]:
+        if len(candidates) == 0:
+            break
+        positions = np.searchsorted(doc_nums, candidates)
+        found = positions < len(doc_nums)
+        found[found] = doc_nums[positions[found]] == candidates[found]
+        candidates = candidates[found]
+    return candidates
+
+
+class PruningStats:
+    '''
+    This class holds the counters of a dynamic pruning top-k retrieval, used to tune the pruning.
+    '''
+
+    def __init__(self):
+        self.postings_total = 0  # postings of all the query terms
+        self.postings_scored = 0  # postings whose contribution was added to a document score
+        self.postings_skipped = 0  # postings never scored
+        self.candidates_scored = 0  # documents whose score was calculated
+
+    def as_dict(self):
+        return {"postings_total": self.postings_total,
+                "postings_scored": self.postings_scored,
+                "postings_skipped": self.postings_skipped,
+                "candidates_scored": self.candidates_scored}
+
+
+class ScoringEngine:
+    '''
+    This class scores documents against a query using contiguous NumPy arrays. Every document is
+    identified by its document number, its position in the document length array, and posting lists
+    are given as arrays of document numbers, so the TF-IDF contributions of a whole posting list are
+    accumulated with a single array operation.
+    '''
+
+    def __init__(self, doc_lengths, doc_ids=None, index=None, generation=None):
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.float64)
+        # Documents with zero length are not normalized
+        self.inverse_lengths = np.ones(len(self.doc_lengths), dtype=np.float64)
+        np.divide(1.0, self.doc_lengths, out=self.inverse_lengths, where=self.doc_lengths > 0)
+        # Document IDs by document number, needed only for posting lists that store document IDs
+        self.doc_ids = doc_ids
+        self.doc_nums = {doc_id: doc_num for doc_num, doc_id in enumerate(doc_ids)} if doc_ids is not None else None
+        self.fingerprint = documents_fingerprint(doc_ids) if doc_ids is not None else None
+        # The binary index or segment snapshot the document numbers refer to, None for the database
+        self.index = index
+        # The generation of the database index the document lengths were read from
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def to_doc_nums(self, doc_ids):
+        '''
+        This method converts a list of document IDs to an array of document numbers, leaving out
+        the documents that are not in the document length array.
+        '''
+        doc_nums = (self.doc_nums.get(doc_id, -1) for doc_id in doc_ids)
+        doc_nums = np.fromiter(doc_nums, dtype=np.int64)
+        return doc_nums[doc_nums >= 0]
+
+    def max_inverse_length(self, doc_nums):
+        '''
+        This method returns the largest inverse document length of a posting list. Multiplied by the
+        weight of the term, it is an upper bound of the score the term adds to any document.
+        '''
+        return float(self.inverse_lengths[doc_nums].max()) if len(doc_nums) else 0.0
+
+    def score(self, postings):
+        '''
+        This method calculates the cosine similarity scores of the documents for a list of
+        (term weight, document numbers array) posting lists, one for every query term.
+        It returns the numbers of the matching documents and their scores.
+        '''
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float64)
+        matched = np.zeros(len(self.doc_lengths), dtype=bool)
+        for weight, doc_nums in postings:
+            # Document numbers are unique within a posting list, so fancy indexing accumulates correctly
+            scores[doc_nums] += weight
+            matched[doc_nums] = True
+
+        doc_nums = np.flatnonzero(matched)
+        scores = scores[doc_nums]
+        # Normalize the document scores using the document length
+        lengths = self.doc_lengths[doc_nums]
+        np.divide(scores, lengths, out=scores, where=lengths > 0)
+        return doc_nums, scores
+
+    def top_k(self, doc_nums, scores, k):
+        '''
+        This method returns the document numbers of the k best scores in descending score order.
+        Equal scores are ordered by document number.
+        '''
+        if k <= 0:
+            return []
+        if len(doc_nums) > k:
+            # Partial selection of the k best scores (and their ties) before sorting only them
+            kth_score = -np.partition(-scores, k - 1)[k - 1]
+            best = scores >= kth_score
+            doc_nums, scores = doc_nums[best], scores[best]
+        order = np.lexsort((doc_nums, -scores))[:k]
+        return doc_nums[order].tolist()
+
+    def top_k_maxscore(self, postings, k):
+        '''
+        This method returns the document numbers of the k best scores like top_k, using MaxScore
+        dynamic pruning. postings is a list of (term weight, sorted document numbers array, maximum
+        inverse document length) posting lists. The documents are visited in document number order and
+        a heap keeps the k best scores. The terms whose upper bounds cannot make a document enter the
+        heap on their own are not used to find candidates, and they are only looked up for candidates
+        that can still enter the heap. It also returns the PruningStats of the retrieval.
+        '''
+        stats = PruningStats()
+        if k <= 0:
+            return [], stats
+        # Terms in ascending upper bound order
+        terms = sorted(((weight * max_inverse_length, weight, doc_nums.tolist())
+                        for weight, doc_nums, max_inverse_length in postings), key=lambda term: term[0])
+        # cumulative_bounds[i] is the upper bound of the score of the terms 0..i
+        cumulative_bounds = list(accumulate(term[0] for term in terms))
+        weights = [term[1] for term in terms]
+        lists = [term[2] for term in terms]
+        positions = [0] * len(terms)
+        stats.postings_total = sum(len(doc_nums) for doc_nums in lists)
+
+        heap = []  # (score, -document number) of the k best documents
+        threshold = -math.inf
+        first_essential = 0
+        while True:
+            # Terms that cannot make a document enter the heap on their own are non essential
+            while first_essential < len(terms) and cumulative_bounds[first_essential] <= threshold:
+                first_essential += 1
+            candidates = [lists[i][positions[i]] for i in range(first_essential, len(terms))
+                          if positions[i] < len(lists[i])]
+            if not candidates:
+                break
+            doc_num = min(candidates)
+
+            score = 0.0
+            for i in range(first_essential, len(terms)):
+                if positions[i] < len(lists[i]) and lists[i][positions[i]] == doc_num:
+                    score += weights[i]
+                    positions[i] += 1
+                    stats.postings_scored += 1
+            inverse_length = float(self.inverse_lengths[doc_num])
+            # Look up the non essential terms while the document can still enter the heap
+            for i in range(first_essential - 1, -1, -1):
+                if score * inverse_length + cumulative_bounds[i] <= threshold:
+                    break
+                positions[i] = bisect_left(lists[i], doc_num, positions[i])
+                if positions[i] < len(lists[i]) and lists[i][positions[i]] == doc_num:
+                    score += weights[i]
+                    positions[i] += 1
+                    stats.postings_scored += 1
+            stats.candidates_scored += 1
+
+            # Normalize the score using the document length
+            if self.doc_lengths[doc_num] > 0:
+                score = score / self.doc_lengths[doc_num]
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -doc_num))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, -doc_num))
+            if len(heap) == k:
+                threshold = heap[0][0]
+
+        stats.postings_skipped = stats.postings_total - stats.postings_scored
+        return [-doc_num for _, doc_num in sorted(heap, reverse=True)], stats
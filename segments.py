@@ -0,0 +1,346 @@
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from itertools import accumulate
+
+import numpy as np
+
+from binary_index import BinaryIndex, write_binary_index
+from metrics import registry as metrics
+from scoring import squared_weight
+
+MANIFEST = "MANIFEST"
+
+
+class SegmentSnapshot:
+    '''
+    This class is a consistent view of the segments of one generation of the manifest. It serves queries
+    like a single BinaryIndex: the documents of every segment are numbered after the documents of the
+    previous segments, and the term frequency of a term is the sum of its term frequencies in the segments.
+    '''
+
+    def __init__(self, generation, names, segments):
+        self.generation = generation
+        self.names = names
+        self.segments = segments  # BinaryIndex of every segment in manifest order
+        # First document number of every segment followed by the number of documents
+        self.offsets = list(accumulate([0] + [segment.get_documents_count() for segment in segments]))
+
+    def get_documents_count(self):
+        return self.offsets[-1]
+
+    def term_frequency(self, term):
+        return sum(segment.dictionary[term][0] for segment in self.segments if term in segment.dictionary)
+
+    def find_term_arrays(self, term):
+        '''
+        This method returns the term frequency of a term, its posting list over all the segments as
+        NumPy arrays of document numbers and term-document frequencies and the maximum inverse document
+        length of the posting list, or None if the term is not in any segment.
+        '''
+        t_freq = 0
+        doc_nums = []
+        t_d_freqs = []
+        max_inverse_length = 0.0
+        for segment, offset in zip(self.segments, self.offsets):
+            word = segment.find_term_arrays(term)
+            if word is not None:
+                t_freq += word[0]
+                doc_nums.append(word[1] + offset)
+                t_d_freqs.append(word[2])
+                max_inverse_length = max(max_inverse_length, word[3])
+        if not doc_nums:
+            return None
+        return t_freq, np.concatenate(doc_nums), np.concatenate(t_d_freqs), max_inverse_length
+
+    def doc_lengths(self):
+        if not self.segments:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate([segment.doc_lengths() for segment in self.segments])
+
+    def find_document(self, doc_num):
+        i = bisect_right(self.offsets, doc_num) - 1
+        return self.segments[i].find_document(doc_num - self.offsets[i])
+
+
+def write_segment(path, documents, postings, docs_count, term_frequency):
+    '''
+    This function writes a segment in the binary index format. documents is the list of documents
+    ({"_id", "title", "url"}) and postings maps every term to its (document number, t_d_freq) pairs.
+    The document lengths are calculated with the term frequencies and the number of documents of the
+    whole index, given by term_frequency(term) and docs_count.
+    '''
+    squared_weights_sums = [0.0] * len(documents)
+    for term, term_postings in postings.items():
+        weight = squared_weight(term_frequency(term), docs_count)
+        for doc_num, _ in term_postings:
+            squared_weights_sums[doc_num] += weight
+    documents = [{"_id": document["_id"], "title": document["title"], "url": document["url"],
+                  "length": math.sqrt(squared_weights_sum)}
+                 for document, squared_weights_sum in zip(documents, squared_weights_sums)]
+    write_binary_index(path, documents, ((term, len(postings[term]), postings[term]) for term in sorted(postings)))
+
+
+def write_rebuilt_segment(path, documents, terms):
+    '''
+    This function writes a segment of all the documents of the index, like write_segment, from posting
+    lists that do not fit in memory. terms() returns a new iterator of (term, postings) in term order
+    every time it is called: it is read once to calculate the document lengths and once more to write
+    the posting lists.
+    '''
+    squared_weights_sums = [0.0] * len(documents)
+    for _, term_postings in terms():
+        weight = squared_weight(len(term_postings), len(documents))
+        for doc_num, _ in term_postings:
+            squared_weights_sums[doc_num] += weight
+    documents = [{"_id": document["_id"], "title": document["title"], "url": document["url"],
+                  "length": math.sqrt(squared_weights_sum)}
+                 for document, squared_weights_sum in zip(documents, squared_weights_sums)]
+    write_binary_index(path, documents, ((term, len(term_postings), term_postings) for term, term_postings in terms()))
+
+
+def bag_postings(documents):
+    '''
+    This function returns the posting lists (term -> list of (document number, t_d_freq)) of the
+    bags of words of a list of documents.
+    '''
+    postings = {}
+    for doc_num, document in enumerate(documents):
+        for term, t_d_freq in document["bag"].items():
+            postings.setdefault(term.lower(), []).append((doc_num, t_d_freq))
+    return postings
+
+
+class SegmentIndex:
+    '''
+    This class keeps the inverted index as a directory of immutable segments in the binary index format,
+    listed by a manifest. New documents are flushed as a small segment, which is visible to the queries
+    as soon as it is added to the manifest. A background merger merges segments of the same size tier, so
+    that a query reads a few large segments instead of many small ones. Every change writes a new manifest
+    and replaces the previous one with a single rename, so readers always see a complete generation of the
+    index while it is updated or rebuilt. Segments replaced by a merge are deleted after grace_period
+    seconds, so that readers in other processes can still open them. There must be a single writer process.
+    '''
+
+    def __init__(self, directory, merge_factor=4, grace_period=60.0):
+        self.directory = directory
+        self.merge_factor = merge_factor  # segments of the same tier merged together
+        self.grace_period = grace_period
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()  # serializes the manifest changes of the writer
+        self.snapshotLocker = threading.Lock()
+        self.current = None
+        self.current_stat = None
+        self.opened = {}  # segment name -> BinaryIndex, shared by the snapshots
+        self.merger = None
+        self.merge_wakeup = threading.Event()
+        self.stopping = False
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_manifest(self):
+        try:
+            with open(self.path(MANIFEST), encoding="utf8") as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {"generation": 0, "segments": [], "obsolete": []}
+
+    def commit(self, manifest):
+        '''
+        This method makes a new generation of the manifest visible and deletes the obsolete segments
+        whose grace period has passed. It must be called holding the lock.
+        '''
+        now = time.time()
+        for entry in [entry for entry in manifest["obsolete"] if entry["since"] + self.grace_period < now]:
+            for extension in (".idx", ".docs"):
+                try:
+                    os.remove(self.path(entry["name"] + extension))
+                except FileNotFoundError:
+                    pass
+            manifest["obsolete"].remove(entry)
+        manifest["generation"] += 1
+        with open(self.path(MANIFEST) + ".tmp", "w", encoding="utf8") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(self.path(MANIFEST) + ".tmp", self.path(MANIFEST))
+
+    def exists(self):
+        return os.path.exists(self.path(MANIFEST))
+
+    def snapshot(self):
+        '''
+        This method returns the SegmentSnapshot of the current manifest. The manifest is read again only
+        when it has been replaced, so the same snapshot is returned until the index changes.
+        '''
+        for _ in range(3):
+            try:
+                stat = os.stat(self.path(MANIFEST))
+                stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                stat = None
+            current = self.current
+            if current is not None and stat == self.current_stat:
+                return current
+            manifest = self.read_manifest()
+            names = [entry["name"] for entry in manifest["segments"]]
+            try:
+                segments = [self.opened.get(name) or BinaryIndex(self.path(name)) for name in names]
+            except FileNotFoundError:
+                continue  # the segments have been merged and deleted since the manifest was read
+            snapshot = SegmentSnapshot(manifest["generation"], names, segments)
+            with self.snapshotLocker:
+                # Segments that are not in the manifest are closed when the last snapshot using them is released
+                self.opened = dict(zip(names, segments))
+                self.current = snapshot
+                self.current_stat = stat
+            return snapshot
+        raise RuntimeError("the segments of {directory} changed while they were opened".format(
+            directory=self.directory))
+
+    def new_segment_name(self):
+        return "segment-" + uuid.uuid4().hex
+
+    def flush(self, documents):
+        '''
+        This method writes a list of new documents ({"_id", "title", "url", "bag"}) as a new segment
+        and makes it visible to the queries. The lengths of the new documents are calculated with the
+        term frequencies of the whole index, and the lengths of the existing documents are updated
+        when their segments are merged.
+        '''
+        if not documents:
+            return
+        documents = sorted(documents, key=lambda document: document["_id"])
+        postings = bag_postings(documents)
+        with metrics.timer("segment_seconds", operation="flush"), self.lock:
+            snapshot = self.snapshot()
+            name = self.new_segment_name()
+            write_segment(self.path(name), documents, postings, snapshot.get_documents_count() + len(documents),
+                          lambda term: snapshot.term_frequency(term) + len(postings[term]))
+            manifest = self.read_manifest()
+            manifest["segments"].append({"name": name, "documents": len(documents)})
+            self.commit(manifest)
+        self.merge_wakeup.set()
+
+    def rebuild(self, documents, terms=None):
+        '''
+        This method replaces the whole index with a single segment of the given documents. The queries
+        use the previous segments until the new one is complete, and the segments flushed during the
+        rebuild are kept. The posting lists are built from the bags of words of the documents, or if
+        terms is given the documents must be sorted by ID and terms() returns their posting lists
+        (see write_rebuilt_segment).
+        '''
+        if terms is None:
+            documents = sorted(documents, key=lambda document: document["_id"])
+            postings = bag_postings(documents)
+
+            def terms():
+                return ((term, postings[term]) for term in sorted(postings))
+
+        with metrics.timer("segment_seconds", operation="rebuild"):
+            replaced = set(entry["name"] for entry in self.read_manifest()["segments"])
+            name = self.new_segment_name()
+            write_rebuilt_segment(self.path(name), documents, terms)
+            with self.lock:
+                manifest = self.read_manifest()
+                self.replace_segments(manifest, replaced, {"name": name, "documents": len(documents)})
+                self.commit(manifest)
+
+    def replace_segments(self, manifest, names, entry):
+        '''
+        This method replaces the segments names of a manifest with a new segment, placed where the
+        first of them was, and marks them as obsolete.
+        '''
+        position = min([i for i, segment in enumerate(manifest["segments"]) if segment["name"] in names],
+                       default=len(manifest["segments"]))
+        manifest["segments"] = [segment for segment in manifest["segments"] if segment["name"] not in names]
+        manifest["segments"].insert(position, entry)
+        manifest["obsolete"].extend({"name": name, "since": time.time()} for name in names)
+
+    def find_merge(self, manifest):
+        '''
+        This method returns the names of merge_factor segments of the smallest size tier that has that
+        many segments, or None. The tier of a segment is the logarithm of its number of documents in
+        base merge_factor, so every document is merged a logarithmic number of times.
+        '''
+        tiers = {}
+        for entry in manifest["segments"]:
+            tier = int(math.log(max(1, entry["documents"]), self.merge_factor))
+            tiers.setdefault(tier, []).append(entry["name"])
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+        return None
+
+    def merge(self, names):
+        '''
+        This method merges segments into a new segment. The documents keep the order of the segments,
+        and their lengths are calculated again with the current term frequencies of the whole index.
+        '''
+        snapshot = self.snapshot()
+        if not set(names) <= set(snapshot.names):
+            return
+        documents = []
+        postings = {}
+        with metrics.timer("segment_seconds", operation="merge"):
+            for name in names:
+                segment = snapshot.segments[snapshot.names.index(name)]
+                offset = len(documents)
+                documents.extend(segment.find_document(doc_num) for doc_num in range(segment.get_documents_count()))
+                for term in segment.dictionary:
+                    _, doc_nums, t_d_freqs = segment.find_term(term)
+                    postings.setdefault(term, []).extend(
+                        (doc_num + offset, t_d_freq) for doc_num, t_d_freq in zip(doc_nums, t_d_freqs))
+            merged_name = self.new_segment_name()
+            write_segment(self.path(merged_name), documents, postings, snapshot.get_documents_count(),
+                          snapshot.term_frequency)
+            with self.lock:
+                manifest = self.read_manifest()
+                if not set(names) <= set(segment["name"] for segment in manifest["segments"]):
+                    # The segments have been replaced by a rebuild meanwhile
+                    for extension in (".idx", ".docs"):
+                        os.remove(self.path(merged_name) + extension)
+                    return
+                self.replace_segments(manifest, set(names), {"name": merged_name, "documents": len(documents)})
+                self.commit(manifest)
+
+    def merge_pending(self):
+        '''
+        This method merges segments until no size tier has merge_factor segments.
+        '''
+        while not self.stopping:
+            names = self.find_merge(self.read_manifest())
+            if names is None:
+                return
+            self.merge(names)
+
+    def start_merger(self, interval=5.0):
+        '''
+        This method starts the background thread that merges segments after every flush, and at
+        least every interval seconds.
+        '''
+        def merge_loop():
+            while not self.stopping:
+                self.merge_wakeup.wait(interval)
+                self.merge_wakeup.clear()
+                self.merge_pending()
+
+        self.stopping = False
+        self.merger = threading.Thread(target=merge_loop, name="segment-merger", daemon=True)
+        self.merger.start()
+
+    def stop_merger(self):
+        '''
+        This method stops the background merger after the merge it is running.
+        '''
+        if self.merger is not None:
+            self.stopping = True
+            self.merge_wakeup.set()
+            self.merger.join()
+            self.merger = None
+            self.stopping = False
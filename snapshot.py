@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import threading
+
+from binary_index import BinaryIndex
+from metrics import registry as metrics
+from positional_index import PositionalIndex
+
+CURRENT = "CURRENT"
+
+
+class Snapshot(BinaryIndex):
+    '''
+    This class is one published version of a SnapshotStore: the binary index of the version, with
+    its positional index if one was exported, and the generation of the version. Like a BinaryIndex
+    it is memory mapped, so opening it reads only the term dictionary and posting lists are decoded
+    when they are queried.
+    '''
+
+    def __init__(self, path, generation):
+        super().__init__(path)
+        self.generation = generation
+        self.positional_index = PositionalIndex(path) if os.path.exists(path + ".pos") else None
+
+
+class SnapshotStore:
+    '''
+    This class keeps versioned snapshots of the index in a directory, so that a query server can rank
+    and return results without database round trips and without building any state: every version is a
+    directory with the binary index (term dictionary and frequencies, posting lists, document lengths and
+    document table) and the positional index, and the CURRENT file names the version that is served.
+    Snippets, relevance feedback and the cache statistics of the database still read the database. A new version is published
+    by replacing CURRENT with a single rename, and the servers that use the store open it in place on
+    their next query. The keep latest versions are kept, so that servers can finish their queries on
+    the version they opened.
+    '''
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.current = None
+        self.current_stat = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_current(self):
+        '''
+        This method returns the generation and the name of the current version, or None if no version
+        has been published.
+        '''
+        try:
+            with open(self.path(CURRENT), encoding="utf8") as current_file:
+                return json.load(current_file)
+        except FileNotFoundError:
+            return None
+
+    def exists(self):
+        return os.path.exists(self.path(CURRENT))
+
+    def publish(self, export):
+        '''
+        This method publishes a new version of the index. export(path) writes the files of the version
+        with the given path prefix, e.g. with Indexer.export_binary_index. It returns the generation of
+        the new version.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        current = self.read_current()
+        generation = current["generation"] + 1 if current is not None else 1
+        name = "snapshot-{generation:08d}".format(generation=generation)
+        os.makedirs(self.path(name), exist_ok=True)
+        with metrics.timer("snapshot_seconds", operation="publish"):
+            export(os.path.join(self.path(name), "index"))
+            with open(self.path(CURRENT) + ".tmp", "w", encoding="utf8") as current_file:
+                json.dump({"generation": generation, "name": name}, current_file)
+                current_file.flush()
+                os.fsync(current_file.fileno())
+            os.replace(self.path(CURRENT) + ".tmp", self.path(CURRENT))
+        # Versions are numbered in publication order, so the oldest ones sort first
+        versions = sorted(entry for entry in os.listdir(self.directory) if entry.startswith("snapshot-"))
+        for old_name in versions[:-self.keep]:
+            shutil.rmtree(self.path(old_name), ignore_errors=True)
+        return generation
+
+    def snapshot(self):
+        '''
+        This method returns the Snapshot of the current version. CURRENT is read again only when it has
+        been replaced, so the same Snapshot is returned until a new version is published. It raises
+        RuntimeError if no version has been published.
+        '''
+        for _ in range(3):
+            try:
+                stat = os.stat(self.path(CURRENT))
+                stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                raise RuntimeError("no snapshot has been published in {directory}".format(
+                    directory=self.directory))
+            current = self.current
+            if current is not None and stat == self.current_stat:
+                return current
+            with self.lock:
+                # Another thread may have opened the version while this one was waiting
+                if self.current is not None and stat == self.current_stat:
+                    return self.current
+                version = self.read_current()
+                try:
+                    with metrics.timer("snapshot_seconds", operation="open"):
+                        snapshot = Snapshot(os.path.join(self.path(version["name"]), "index"),
+                                            version["generation"])
+                except FileNotFoundError:
+                    continue  # the version has been deleted since CURRENT was read
+                print("Serving snapshot {generation} of {directory}".format(generation=snapshot.generation,
+                                                                             directory=self.directory))
+                self.current = snapshot
+                self.current_stat = stat
+            return snapshot
+        raise RuntimeError("the snapshots of {directory} changed while they were opened".format(
+            directory=self.directory))
@@ -0,0 +1,92 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import nltk
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+try:
+    # The analysis of the pages needs the NLTK stop words and tokenizer data
+    nltk.corpus.stopwords.words("english")
+    nltk.word_tokenize("a test")
+except LookupError:
+    pytest.skip("the NLTK data is not installed", allow_module_level=True)
+
+from async_crawler import AsyncCrawler  # noqa: E402
+from mongodb import MongoDB  # noqa: E402
+
+PAGES = 40
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    '''
+    This class serves a site of PAGES pages, where page n links to pages 2n + 1 and 2n + 2, to a
+    missing page and to a mail address.
+    '''
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "page" or not parts[1].isdigit() or int(parts[1]) >= PAGES:
+            self.send_error(404)
+            return
+        number = int(parts[1])
+        links = "".join('<a href="/page/{child}">child</a>'.format(child=child)
+                        for child in (2 * number + 1, 2 * number + 2))
+        body = ('<html><head><title>Page {number}</title></head><body><p>apple banana number{number}</p>'
+                '{links}<a href="/missing">missing</a><a href="mailto:someone@example.com">mail</a>'
+                '</body></html>').format(number=number, links=links).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{port}".format(port=server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(site, db, state_dir, keep, max_size):
+    crawler = AsyncCrawler(site + "/page/0", keep=keep, max_size=max_size, num_threads=2, timeout=5,
+                           max_in_flight=8, per_host=4, state_dir=state_dir, analysis_workers=2,
+                           page_batch_size=4, db=db)
+    crawler.crawl()
+    return crawler
+
+
+def crawled_urls(db):
+    return [record["url"] for record in db.crawler_db.find({}, {"url": 1})]
+
+
+def test_crawl_the_whole_site(site, tmp_path):
+    db = MongoDB(client=mongomock.MongoClient(), database="test_async_crawler")
+    crawler = crawl(site, db, str(tmp_path), keep=False, max_size=100)
+    urls = crawled_urls(db)
+    assert sorted(urls) == sorted("{site}/page/{number}".format(site=site, number=number) for number in range(PAGES))
+    assert crawler.crawled_pages == PAGES
+    # The index of the crawled pages is built in the given database
+    assert db.get_documents_count() == PAGES
+    assert db.indexer_db.find_one({"term": "appl"}) is not None
+
+
+def test_resume_crawls_every_page_once(site, tmp_path):
+    '''
+    This test checks that a crawl stopped at its maximum number of pages resumes with the pages it did
+    not save, so that the two crawls save every page of the site exactly once.
+    '''
+    db = MongoDB(client=mongomock.MongoClient(), database="test_async_crawler")
+    crawl(site, db, str(tmp_path), keep=False, max_size=15)
+    assert len(crawled_urls(db)) == 15
+    crawler = crawl(site, db, str(tmp_path), keep=True, max_size=100)
+    urls = crawled_urls(db)
+    assert crawler.crawled_pages == PAGES - 15
+    assert sorted(urls) == sorted("{site}/page/{number}".format(site=site, number=number) for number in range(PAGES))
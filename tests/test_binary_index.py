@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+
+from binary_index import (BinaryIndex, decode_deltas, decode_varints, decode_varints_array,
+                          documents_fingerprint, encode_deltas, encode_varints, write_binary_index)
+
+EDGE_VALUES = [0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 2 ** 32 - 1, 2 ** 32, 2 ** 62]
+
+
+def test_varints_round_trip():
+    '''
+    This test checks that the scalar and the array decoders read back the values of encode_varints,
+    including the values at the byte boundaries of the encoding.
+    '''
+    rnd = random.Random(1)
+    values = EDGE_VALUES + [rnd.randrange(2 ** rnd.randrange(1, 40)) for _ in range(1000)]
+    encoded = b"junk" + encode_varints(values)
+    decoded, offset = decode_varints(encoded, 4, len(values))
+    assert decoded == values
+    assert offset == len(encoded)
+    assert decode_varints_array(encoded, 4, len(encoded) - 4).tolist() == values
+    assert decode_varints_array(encoded, 4, 0).tolist() == []
+
+
+def test_deltas_round_trip():
+    '''
+    This test checks that decode_deltas reads back sorted values encoded with encode_deltas.
+    '''
+    rnd = random.Random(2)
+    values = sorted(rnd.sample(range(10 ** 6), 500))
+    encoded = encode_deltas(values)
+    decoded, offset = decode_deltas(encoded, 0, len(values))
+    assert decoded == values
+    assert offset == len(encoded)
+    assert np.cumsum(decode_varints_array(encoded, 0, len(encoded))).tolist() == values
+
+
+def test_binary_index_round_trip(tmp_path):
+    '''
+    This test checks that a binary index returns the posting lists, the bounds and the document
+    table it was written with.
+    '''
+    rnd = random.Random(3)
+    documents = [{"_id": "doc%03d" % i, "title": "Title %d" % i if i % 5 else None,
+                  "url": "http://example.com/%d" % i, "length": rnd.uniform(0.5, 10.0) if i % 7 else 0.0}
+                 for i in range(200)]
+    terms = []
+    for term in sorted(["apple", "banana", "cherry", "δέντρο", "rare"]):
+        doc_nums = rnd.sample(range(len(documents)), 1 if term == "rare" else rnd.randrange(1, 150))
+        postings = [(doc_num, rnd.randrange(1, 300)) for doc_num in doc_nums]
+        terms.append((term, sum(t_d_freq for _, t_d_freq in postings), postings))
+
+    path = str(tmp_path / "index")
+    write_binary_index(path, documents, terms)
+    index = BinaryIndex(path)
+    try:
+        assert index.get_documents_count() == len(documents)
+        assert index.fingerprint == documents_fingerprint(document["_id"] for document in documents)
+        assert index.doc_lengths().tolist() == [document["length"] for document in documents]
+        for doc_num, document in enumerate(documents):
+            assert index.find_document(doc_num) == {"_id": document["_id"], "title": document["title"] or "",
+                                                    "url": document["url"]}
+
+        for term, t_freq, postings in terms:
+            postings = sorted(postings)
+            doc_nums = [doc_num for doc_num, _ in postings]
+            t_d_freqs = [t_d_freq for _, t_d_freq in postings]
+            assert index.term_frequency(term) == t_freq
+            assert index.find_term(term) == (t_freq, doc_nums, t_d_freqs)
+            arrays = index.find_term_arrays(term)
+            assert arrays[0] == t_freq
+            assert arrays[1].tolist() == doc_nums
+            assert arrays[2].tolist() == t_d_freqs
+            assert arrays[3] == max(1.0 / documents[doc_num]["length"] if documents[doc_num]["length"] > 0
+                                    else 1.0 for doc_num in doc_nums)
+        assert index.find_term("missing") is None
+        assert index.find_term_arrays("missing") is None
+        assert index.term_frequency("missing") == 0
+    finally:
+        index.close()
+
+
+def test_fingerprint_depends_on_document_order():
+    '''
+    This test checks that the fingerprint tells apart document tables that number the same
+    documents differently.
+    '''
+    assert documents_fingerprint(["a", "b"]) == documents_fingerprint(iter(["a", "b"]))
+    assert documents_fingerprint(["a", "b"]) != documents_fingerprint(["b", "a"])
+    assert documents_fingerprint(["ab"]) != documents_fingerprint(["a", "b"])
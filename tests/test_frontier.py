@@ -0,0 +1,96 @@
+import os
+
+from frontier import BloomFilter, Frontier, normalize_url
+
+URLS = ["http://example.com/page/{number}".format(number=number) for number in range(100)]
+
+
+def pop_all(frontier):
+    urls = []
+    url = frontier.pop()
+    while url is not None:
+        urls.append(url)
+        url = frontier.pop()
+    return urls
+
+
+def test_normalize_url():
+    base = "http://Example.com/a/b.html"
+    assert normalize_url(base, "c.html#top") == "http://example.com/a/c.html"
+    assert normalize_url(base, "HTTPS://Example.com:443/x?q=1") == "https://example.com/x?q=1"
+    assert normalize_url(base, "http://example.com:8080") == "http://example.com:8080/"
+    assert normalize_url(base, "mailto:someone@example.com") is None
+    assert normalize_url(base, "javascript:void(0)") is None
+    assert normalize_url(base, "http://[::1") is None
+    assert normalize_url(base, "") is None
+
+
+def test_bloom_filter(tmp_path):
+    '''
+    This test checks that the Bloom filter has no false negatives, about the expected rate of false
+    positives, and the same strings after it is saved and loaded.
+    '''
+    bloom = BloomFilter(capacity=5000, error_rate=0.01)
+    added = ["http://example.com/{number}".format(number=number) for number in range(5000)]
+    for url in added:
+        bloom.add(url)
+    assert all(url in bloom for url in added)
+    false_positives = sum("http://example.org/{number}".format(number=number) in bloom for number in range(5000))
+    assert false_positives < 5000 * 0.03
+
+    path = str(tmp_path / "seen.bloom")
+    bloom.save(path)
+    loaded = BloomFilter.load(path)
+    assert (loaded.num_bits, loaded.num_hashes, loaded.count, loaded.bits) == \
+        (bloom.num_bits, bloom.num_hashes, bloom.count, bloom.bits)
+    assert all(url in loaded for url in added)
+
+
+def test_spilled_urls_keep_their_order(tmp_path):
+    frontier = Frontier(str(tmp_path), max_in_memory=10, spill_size=7)
+    assert all(frontier.add(url) for url in URLS)
+    assert not any(frontier.add(url) for url in URLS[::3])
+    assert len(frontier) == len(URLS)
+    assert any(name.startswith("spill-") for name in os.listdir(str(tmp_path)))
+    # Urls added while the spilled urls are crawled go after them
+    first = [frontier.pop() for _ in range(20)]
+    frontier.add("http://example.com/late")
+    assert first + pop_all(frontier) == URLS + ["http://example.com/late"]
+    assert len(frontier) == 0
+
+
+def test_requeue_puts_urls_first(tmp_path):
+    frontier = Frontier(str(tmp_path), max_in_memory=10, spill_size=7)
+    for url in URLS:
+        frontier.add(url)
+    popped = [frontier.pop() for _ in range(5)]
+    frontier.requeue(popped[2:])
+    assert pop_all(frontier) == URLS[2:]
+
+
+def test_resume_from_checkpoint(tmp_path):
+    '''
+    This test checks that a crawl that stops after a checkpoint resumes with the queue and the seen
+    urls of the checkpoint, even when spill files were read after it.
+    '''
+    state_dir = str(tmp_path)
+    frontier = Frontier(state_dir, max_in_memory=10, spill_size=7)
+    for url in URLS:
+        frontier.add(url)
+    crawled = [frontier.pop() for _ in range(15)]
+    frontier.checkpoint()
+    # Urls popped after the checkpoint are lost with the crawl that stops
+    for _ in range(30):
+        frontier.pop()
+
+    resumed = Frontier(state_dir, resume=True, max_in_memory=10, spill_size=7)
+    assert resumed.resumed
+    assert len(resumed) == len(URLS) - len(crawled)
+    assert not resumed.add(URLS[0])
+    assert resumed.add("http://example.com/new")
+    assert crawled + pop_all(resumed) == URLS + ["http://example.com/new"]
+
+    fresh = Frontier(state_dir, max_in_memory=10, spill_size=7)
+    assert not fresh.resumed
+    assert len(fresh) == 0
+    assert os.listdir(state_dir) == []
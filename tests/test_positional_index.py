@@ -0,0 +1,90 @@
+import random
+from bisect import bisect_left
+
+from positional_index import SKIP_INTERVAL, PositionalIndex, write_positional_index
+
+FINGERPRINT = 0x0123456789ABCDEF
+
+
+def make_index(tmp_path, documents):
+    '''
+    This function writes the positional index of a list of token lists, numbered by their position.
+    '''
+    postings = {}
+    for doc_num, tokens in enumerate(documents):
+        for position, token in enumerate(tokens):
+            postings.setdefault(token, {}).setdefault(doc_num, []).append(position)
+    terms = ((term, list(postings[term].items())) for term in sorted(postings))
+    path = str(tmp_path / "index")
+    write_positional_index(path, len(documents), FINGERPRINT, terms)
+    return PositionalIndex(path), postings
+
+
+def random_documents(seed, count=1500):
+    '''
+    This function returns random documents where "the" is in every document, so that its posting list
+    spans many skip blocks, and the other terms are rarer.
+    '''
+    rnd = random.Random(seed)
+    vocabulary = ["the", "new", "york", "times", "square", "garden"]
+    weights = [8, 3, 2, 2, 1, 1]
+    return [["the"] + rnd.choices(vocabulary, weights, k=rnd.randrange(1, 30)) for _ in range(count)]
+
+
+def test_cursors_match_the_posting_lists(tmp_path):
+    '''
+    This test checks that next, advance and positions of the cursors return the written posting lists,
+    and that advance jumps over skip blocks.
+    '''
+    index, postings = make_index(tmp_path, random_documents(1))
+    rnd = random.Random(2)
+    try:
+        assert index.get_documents_count() == 1500
+        assert index.fingerprint == FINGERPRINT
+        assert index.find_postings("missing") is None
+        for term, documents in postings.items():
+            doc_nums = sorted(documents)
+            cursor = index.find_postings(term)
+            assert len(cursor) == len(doc_nums)
+            visited = [cursor.doc]
+            while cursor.next() is not None:
+                visited.append(cursor.doc)
+            assert visited == doc_nums
+
+            cursor = index.find_postings(term)
+            target = 0
+            while True:
+                target += rnd.randrange(0, 200)
+                i = bisect_left(doc_nums, target)
+                expected = doc_nums[i] if i < len(doc_nums) else None
+                assert cursor.advance(target) == expected
+                if expected is None:
+                    break
+                assert cursor.positions().tolist() == documents[expected]
+        assert len(postings["the"]) > 4 * SKIP_INTERVAL
+        cursor = index.find_postings("the")
+        cursor.advance(1400)
+        assert cursor.blocks_skipped > 0
+    finally:
+        index.close()
+
+
+def test_phrases_match_brute_force(tmp_path):
+    '''
+    This test checks find_phrase against a scan of the documents, for phrases and proximity windows.
+    '''
+    documents = random_documents(3)
+    index, _ = make_index(tmp_path, documents)
+    queries = [["new", "york"], ["new", "york", "times"], ["the", "the"], ["york", "new", "york"],
+               ["square", "garden"], ["garden"], ["new", "missing"]]
+    try:
+        for terms in queries:
+            expected = [doc_num for doc_num, tokens in enumerate(documents)
+                        if any(tokens[i:i + len(terms)] == terms for i in range(len(tokens)))]
+            assert index.find_phrase(terms).tolist() == expected
+            for window in (2, 5):
+                expected = [doc_num for doc_num, tokens in enumerate(documents)
+                            if any(all(term in tokens[i:i + window] for term in terms) for i in range(len(tokens)))]
+                assert index.find_phrase(terms, window=window).tolist() == expected
+    finally:
+        index.close()
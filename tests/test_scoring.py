@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+
+from scoring import ScoringEngine, intersect_postings
+
+
+def random_postings(rnd, docs_count, num_terms):
+    '''
+    This function returns (term weight, sorted document numbers array) posting lists of random lengths.
+    '''
+    postings = []
+    for _ in range(num_terms):
+        size = rnd.choice([1, 5, 50, docs_count // 2, docs_count])
+        doc_nums = np.array(sorted(rnd.sample(range(docs_count), size)), dtype=np.int64)
+        postings.append((rnd.uniform(0.1, 5.0), doc_nums))
+    return postings
+
+
+def test_maxscore_matches_exhaustive_top_k():
+    '''
+    This test checks that the MaxScore retrieval returns the documents and the scores of the exhaustive
+    scoring, and that it skips postings once the heap is full.
+    '''
+    rnd = random.Random(1)
+    docs_count = 2000
+    doc_lengths = [rnd.uniform(1.0, 50.0) if i % 50 else 0.0 for i in range(docs_count)]
+    engine = ScoringEngine(doc_lengths)
+    skipped = 0
+    for _ in range(50):
+        postings = random_postings(rnd, docs_count, rnd.randrange(1, 6))
+        doc_nums, scores = engine.score(postings)
+        all_scores = dict(zip(doc_nums.tolist(), scores.tolist()))
+        for k in (0, 1, 10, 100, docs_count + 1):
+            expected = engine.top_k(doc_nums, scores, k)
+            bounded = [(weight, doc_nums, engine.max_inverse_length(doc_nums)) for weight, doc_nums in postings]
+            found, stats = engine.top_k_maxscore(bounded, k)
+            assert len(found) == len(expected)
+            assert np.allclose([all_scores[doc_num] for doc_num in found],
+                               [all_scores[doc_num] for doc_num in expected])
+            assert stats.postings_scored + stats.postings_skipped == stats.postings_total
+            skipped += stats.postings_skipped
+    assert skipped > 0
+
+
+def test_maxscore_orders_ties_by_document_number():
+    engine = ScoringEngine([1.0] * 10)
+    postings = [(1.0, np.arange(10, dtype=np.int64), 1.0), (2.0, np.array([7, 8], dtype=np.int64), 1.0)]
+    found, _ = engine.top_k_maxscore(postings, 4)
+    assert found == [7, 8, 0, 1]
+    assert engine.top_k(*engine.score([postings[0][:2], postings[1][:2]]), 4) == [7, 8, 0, 1]
+
+
+def test_intersect_postings_matches_set_intersection():
+    rnd = random.Random(2)
+    for _ in range(200):
+        postings = [doc_nums for _, doc_nums in random_postings(rnd, 500, rnd.randrange(1, 5))]
+        expected = sorted(set.intersection(*(set(doc_nums.tolist()) for doc_nums in postings)))
+        assert intersect_postings(postings).tolist() == expected
+    empty = np.zeros(0, dtype=np.int64)
+    assert intersect_postings([np.arange(10), empty, np.arange(5)]).tolist() == []
+    assert intersect_postings([np.array([3, 9]), np.array([1, 2, 3, 4])]).tolist() == [3]
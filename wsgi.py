@@ -0,0 +1,18 @@
+import os
+
+from app import app, get_query_handler, warm_up
+
+# Entry point of WSGI servers, e.g. gunicorn --workers 4 --threads 8 wsgi:app
+# Every worker process creates its own Query Handler and database connection pool on its first
+# request, configured by the QUERY_HANDLER_THREADS, BINARY_INDEX_PATH and MONGO_MAX_POOL_SIZE
+# environment variables.
+# With SNAPSHOT_PATH the workers serve the snapshots published by "python indexer.py snapshot" and
+# load the current one when they start, so they serve at full speed from their first request. If no
+# snapshot has been published yet the workers start anyway and load the first one when it is published.
+# The snapshot files are memory mapped, so the workers share them in the page cache. Do not use
+# --preload: the Query Handler starts threads, which do not survive the fork of the workers.
+if os.getenv("SNAPSHOT_PATH") and get_query_handler().is_initialized():
+    warm_up()
+
+if __name__ == "__main__":
+    app.run(threaded=True)